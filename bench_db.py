@@ -0,0 +1,70 @@
+"""Database micro-benchmark: per-query connections vs the shared pool
+
+Usage: python bench_db.py [queries] [concurrency]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+import database
+
+
+async def seed(movies: int = 10000):
+    async with database._writer() as db:
+        await db.executemany(
+            "INSERT INTO movies (code, file_id, title, added_date) VALUES (?, ?, ?, ?)",
+            [(f"KINO{i:05d}", f"file_{i}", f"Movie {i}", "2024-01-01") for i in range(movies)]
+        )
+
+
+async def run(label: str, lookup, queries: int, concurrency: int):
+    # Skewed like real traffic: a few popular codes, a long tail and some misses
+    codes = [f"KINO{int(random.paretovariate(0.8)) % 12000:05d}" for _ in range(queries)]
+    chunk = queries // concurrency
+
+    async def worker(part):
+        for code in part:
+            await lookup(code)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(codes[i * chunk:(i + 1) * chunk]) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {chunk * concurrency / elapsed:>10.0f} queries/sec")
+
+
+async def main():
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+    await database.open_db(path)
+    await database.init_db()
+    await seed()
+
+    async def per_query_connection(code):
+        # What every database.py function used to do
+        async with aiosqlite.connect(path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute("SELECT * FROM movies WHERE code = ?", (code.upper(),)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    await run("connection per query", per_query_connection, queries, concurrency)
+
+    async def pooled_uncached(code):
+        database.movie_cache.clear()
+        return await database.get_movie_by_code(code)
+
+    await run("pooled connections", pooled_uncached, queries, concurrency)
+    await run("pooled + movie cache", database.get_movie_by_code, queries, concurrency)
+    print(f"movie cache: {database.movie_cache.stats()}")
+    await database.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+    TelegramForbiddenError, TelegramBadRequest
+)
+
+from config import (
+    MESSAGES, BROADCAST_RATE, BROADCAST_WORKERS, BROADCAST_PAGE_SIZE,
+    BROADCAST_PROGRESS_INTERVAL, BROADCAST_MAX_RETRIES
+)
+from database import (
+    create_broadcast, get_broadcast, get_running_broadcasts, save_broadcast_progress,
+    finish_broadcast, iter_segment_pages, count_segment_users, mark_user_inactive
+)
+from keyboards import get_broadcast_progress_keyboard
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Global send rate limiter shared by all broadcast workers"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while (after a RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+rate_limiter = TokenBucket(BROADCAST_RATE)
+_jobs = {}  # job id -> asyncio.Task
+
+
+# Errors meaning the user can never receive messages again (until they come back)
+_DEAD_RECIPIENT_ERRORS = ("bot was blocked", "user is deactivated", "chat not found", "bot was kicked")
+
+
+def _is_dead_recipient(error: Exception) -> bool:
+    message = str(error).lower()
+    return any(reason in message for reason in _DEAD_RECIPIENT_ERRORS)
+
+
+async def _deliver(bot: Bot, job: dict, user_id: int) -> bool:
+    """Copy the broadcast message to one user, retrying flood-control and network errors"""
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await rate_limiter.acquire()
+        try:
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=job['from_chat_id'],
+                message_id=job['message_id']
+            )
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning(f"Broadcast {job['id']}: flood control, waiting {e.retry_after}s")
+            rate_limiter.pause(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logger.warning(f"Broadcast {job['id']}: temporary error for {user_id}: {e}")
+            await asyncio.sleep(2 ** attempt)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            if _is_dead_recipient(e):
+                mark_user_inactive(user_id)
+            else:
+                logger.info(f"Broadcast {job['id']}: failed to send to {user_id}: {e}")
+            return False
+        except Exception as e:
+            logger.info(f"Broadcast {job['id']}: failed to send to {user_id}: {e}")
+            return False
+    return False
+
+
+async def _update_progress(bot: Bot, job: dict, text: str, keyboard=None):
+    if not job['progress_message_id']:
+        return
+    try:
+        await bot.edit_message_text(
+            text,
+            chat_id=job['from_chat_id'],
+            message_id=job['progress_message_id'],
+            reply_markup=keyboard
+        )
+    except Exception as e:
+        # "message is not modified" and friends are harmless here
+        logger.debug(f"Broadcast {job['id']}: progress not updated: {e}")
+
+
+def _progress_text(job: dict, key: str = "broadcast_progress"):
+    return MESSAGES[key].format(
+        done=job['sent'] + job['failed'],
+        total=job['total'],
+        success=job['sent'],
+        failed=job['failed']
+    )
+
+
+async def _run(bot: Bot, job: dict):
+    workers = asyncio.Semaphore(BROADCAST_WORKERS)
+    keyboard = get_broadcast_progress_keyboard(job['id'])
+    last_progress = 0.0
+
+    async def send(user_id):
+        async with workers:
+            return await _deliver(bot, job, user_id)
+
+    try:
+        pages = iter_segment_pages(
+            job['segment'], job['segment_value'], after_id=job['cursor'], page_size=BROADCAST_PAGE_SIZE
+        )
+        async for user_ids in pages:
+            results = await asyncio.gather(*(send(uid) for uid in user_ids))
+            sent = sum(results)
+            job['sent'] += sent
+            job['failed'] += len(results) - sent
+            job['cursor'] = user_ids[-1]
+            await save_broadcast_progress(job['id'], job['cursor'], job['sent'], job['failed'])
+
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await _update_progress(bot, job, _progress_text(job), keyboard)
+
+        await finish_broadcast(job['id'])
+        await _update_progress(bot, job, _progress_text(job, "broadcast_success"))
+        logger.info(f"Broadcast {job['id']} done: {job['sent']} sent, {job['failed']} failed")
+    except asyncio.CancelledError:
+        # Shutdown: progress up to the last page is saved, resumed on next start
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast {job['id']} crashed, will resume on restart: {e}")
+    finally:
+        _jobs.pop(job['id'], None)
+
+
+def _spawn(bot: Bot, job: dict):
+    _jobs[job['id']] = asyncio.create_task(_run(bot, job))
+
+
+async def start_broadcast(bot: Bot, admin_id: int, from_chat_id: int, message_id: int,
+                          segment: str = 'all', segment_value=None):
+    """Create a broadcast job for a message and start sending it to a segment in the background"""
+    total = await count_segment_users(segment, segment_value)
+    progress = await bot.send_message(from_chat_id, MESSAGES["broadcast_progress"].format(
+        done=0, total=total, success=0, failed=0
+    ))
+    job_id = await create_broadcast(
+        admin_id, from_chat_id, message_id, progress.message_id, total, segment, segment_value
+    )
+    _spawn(bot, await get_broadcast(job_id))
+    return job_id
+
+
+async def cancel_broadcast(bot: Bot, job_id: int):
+    """Stop a running broadcast; returns False if it was not running"""
+    task = _jobs.pop(job_id, None)
+    if task is None:
+        return False
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    await finish_broadcast(job_id, 'cancelled')
+    job = await get_broadcast(job_id)
+    await _update_progress(bot, job, _progress_text(job, "broadcast_cancelled"))
+    return True
+
+
+async def resume_broadcasts(bot: Bot):
+    """Restart broadcasts that were interrupted by a restart or crash"""
+    for job in await get_running_broadcasts():
+        if job['id'] not in _jobs:
+            logger.info(f"Resuming broadcast {job['id']} after user {job['cursor']}")
+            _spawn(bot, job)
+
+
+async def stop_broadcasts():
+    """Cancel running broadcast tasks on shutdown (they resume on next start)"""
+    tasks = list(_jobs.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -9,10 +9,95 @@ ADMIN_IDS = [int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",")
 
 # Database
 DATABASE_PATH = os.getenv("DATABASE_PATH", "bot_database.db")
+DB_READ_CONNECTIONS = int(os.getenv("DB_READ_CONNECTIONS", "4"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # page cache per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Write-behind buffer for user upserts
+USER_FLUSH_INTERVAL_MS = int(os.getenv("USER_FLUSH_INTERVAL_MS", "2000"))
+USER_FLUSH_MAX_PENDING = int(os.getenv("USER_FLUSH_MAX_PENDING", "500"))
+
+# Movie lookup cache (misses are cached too, for mistyped codes)
+MOVIE_CACHE_SIZE = int(os.getenv("MOVIE_CACHE_SIZE", "5000"))
+MOVIE_CACHE_TTL = int(os.getenv("MOVIE_CACHE_TTL", "600"))
+MOVIE_CACHE_NEGATIVE_TTL = int(os.getenv("MOVIE_CACHE_NEGATIVE_TTL", "60"))
+MOVIE_CACHE_WARM = int(os.getenv("MOVIE_CACHE_WARM", "500"))  # most viewed movies loaded on startup
+MULTI_CODE_LIMIT = int(os.getenv("MULTI_CODE_LIMIT", "10"))  # codes per message, one media group
+SERIES_GROUP_DELAY = float(os.getenv("SERIES_GROUP_DELAY", "1.5"))  # pause between episode albums
+
+# Per-movie delivery counters
+POPULARITY_FLUSH_INTERVAL_MS = int(os.getenv("POPULARITY_FLUSH_INTERVAL_MS", "10000"))
+TOP_MOVIES_SIZE = int(os.getenv("TOP_MOVIES_SIZE", "20"))
+
+# Subscription verdict cache, per (user_id, channel_id)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "100000"))
+SUBSCRIPTION_POSITIVE_TTL = int(os.getenv("SUBSCRIPTION_POSITIVE_TTL", "600"))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "30"))
+
+# get_chat_member fan-out: global concurrency, per-call timeout (seconds) and
+# whether a channel that could not be checked (error/timeout) lets the user through
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv("SUBSCRIPTION_CHECK_CONCURRENCY", "20"))
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv("SUBSCRIPTION_CHECK_TIMEOUT", "5"))
+SUBSCRIPTION_FAIL_OPEN = os.getenv("SUBSCRIPTION_FAIL_OPEN", "false").lower() in ("1", "true", "yes")
+
+# Rows in channel_members (kept fresh by chat_member updates) older than this
+# many seconds are re-verified through the API
+MEMBERSHIP_MAX_AGE = int(os.getenv("MEMBERSHIP_MAX_AGE", str(7 * 24 * 3600)))
 
 # Default mandatory channel (will be added automatically)
 DEFAULT_CHANNEL_ID = "-1003426188280"  # Your main channel ID
 
+# Inline mode (@bot <query>): in-process result cache, Telegram-side cache_time
+# (seconds) and how many matches one query can page through
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "2000"))
+INLINE_CACHE_TTL = int(os.getenv("INLINE_CACHE_TTL", "300"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS", "200"))
+
+# Bulk movie import: rows inserted per transaction
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+
+# Admin statistics snapshot lifetime (seconds)
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "30"))
+# How often daily counters (new users, movies sent) are rolled up into `statistics`
+STATS_FLUSH_INTERVAL_MS = int(os.getenv("STATS_FLUSH_INTERVAL_MS", "60000"))
+
+# Broadcasts: global send rate (Telegram allows ~30 msg/s), concurrent
+# workers, users per persisted page and progress message refresh (seconds)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "10"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "100"))
+BROADCAST_PROGRESS_INTERVAL = int(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+# FSM storage (admin conversations) in SQLite: conversations idle longer than
+# FSM_STATE_TTL seconds are evicted every FSM_SWEEP_INTERVAL seconds.
+# Every state (including "no conversation") is cached in process for
+# FSM_CACHE_TTL seconds. With one bot process all writes go through that cache,
+# so it is exact and most updates never touch SQLite. With several processes
+# on one database, reads are only eventually consistent within FSM_CACHE_TTL:
+# set it to 0 there to always read the shared row.
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_SWEEP_INTERVAL = int(os.getenv("FSM_SWEEP_INTERVAL", "600"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "20000"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "300"))
+
+# Webhook mode: updates are acknowledged at once and processed by
+# UPDATE_WORKERS tasks from a queue of at most UPDATE_QUEUE_SIZE updates
+# (Telegram gets a 503 and retries once it's full). The last UPDATE_DEDUP_SIZE
+# update_ids are remembered to drop redelivered updates; on shutdown the queue
+# is drained for up to UPDATE_DRAIN_TIMEOUT seconds.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "20"))
+# Queued updates are served by priority (admins, callbacks, movie requests,
+# /start). After UPDATE_PRIORITY_BURST higher-priority updates in a row the
+# oldest waiting lower-priority one goes next; movie requests and /start that
+# waited longer than UPDATE_SHED_AFTER_MS are dropped instead of answered late.
+UPDATE_PRIORITY_BURST = int(os.getenv("UPDATE_PRIORITY_BURST", "8"))
+UPDATE_SHED_AFTER_MS = int(os.getenv("UPDATE_SHED_AFTER_MS", "10000"))
+
 # Messages
 MESSAGES = {
     "start": "🎬 Assalomu alaykum! Kino bot'ga xush kelibsiz!\n\n"
@@ -25,21 +110,67 @@ MESSAGES = {
     
     "movie_not_found": "❌ Kino topilmadi. Iltimos, to'g'ri kodni kiriting.",
     
+    "movie_suggestions": "🔎 Bunday kod topilmadi. Balki shulardan birini qidiryapsiz:",
+    
+    "movies_partly_found": "❌ Quyidagi kodlar topilmadi: {codes}",
+    
+    "too_many_codes": "⚠️ Bir xabarda ko'pi bilan {limit} ta kod yuboriladi. Bu kodlar yuborilmadi: {codes}",
+    
+    "episodes_start": "📺 Serial kodini kiriting (kino avval qo'shilgan bo'lishi kerak):",
+    
+    "episodes_upload": "📹 {code} uchun qismlarni yuboring (bir nechta video yoki albom).\n\n"
+                       "Hozirgi qismlar: {count} ta. Tugatgach \"✅ Tayyor\" tugmasini bosing.",
+    
+    "episodes_added": "✅ {code} ga {first}-{last} qismlar qo'shildi!",
+    
     "movie_sent": "✅ Kino jo'natildi!",
     
     "admin_panel": "👨‍💼 Admin panel\n\nQuyidagi bo'limlardan birini tanlang:",
     
     "statistics": "📊 Statistika:\n\n"
                   "👥 Jami foydalanuvchilar: {total_users}\n"
-                  "🟢 Faol foydalanuvchilar: {active_users}\n"
+                  "🟢 Faol foydalanuvchilar (7 kun): {active_users}\n"
+                  "   • 24 soat: {active_1d} | 30 kun: {active_30d}\n"
                   "🎬 Jami kinolar: {total_movies}\n"
                   "📢 Majburiy kanallar: {total_channels}",
     
-    "broadcast_start": "📢 Barcha foydalanuvchilarga yubormoqchi bo'lgan xabaringizni yozing:",
+    "daily_statistics": "📈 Kunlik statistika (oxirgi {days} kun):\n\n"
+                        "{rows}\n"
+                        "Jami: 👥 +{new_users} | 🎬 {movies_sent}",
+    
+    "import_start": "📥 Kinolar ro'yxatini CSV yoki JSONL fayl qilib yuboring.\n\n"
+                    "Ustunlar: code, file_id, title, description, type (video yoki document)\n"
+                    "CSV faylning birinchi qatori sarlavha bo'lishi kerak.",
+    
+    "import_done": "✅ Import tugadi!\n\n"
+                   "➕ Qo'shildi: {inserted}\n"
+                   "♻️ Takroriy kodlar: {duplicates}\n"
+                   "⚠️ Noto'g'ri qatorlar: {invalid}",
+    
+    "broadcast_segment": "📢 Xabar kimlarga yuborilsin?\n\n"
+                         "🟢 — oxirgi 24 soat / 7 / 30 kunda faol bo'lganlar",
+    
+    "broadcast_joined": "📅 Qaysi sanadan keyin qo'shilgan foydalanuvchilarga yuborilsin?\n\n"
+                        "Misol: 2024-05-01",
+    
+    "broadcast_movie": "🎬 Qaysi kino kodini so'ragan foydalanuvchilarga yuborilsin?",
+    
+    "broadcast_empty": "❌ Bu guruhda birorta ham foydalanuvchi yo'q.",
+    
+    "broadcast_start": "👥 Qabul qiluvchilar: {audience} — {count} ta foydalanuvchi.\n\n"
+                       "📢 Yubormoqchi bo'lgan xabaringizni yozing:",
     
     "broadcast_success": "✅ Xabar {success} ta foydalanuvchiga yuborildi!\n"
                          "❌ {failed} ta foydalanuvchiga yuborilmadi.",
     
+    "broadcast_progress": "📢 Xabar yuborilmoqda... ({done}/{total})\n\n"
+                          "✅ Yuborildi: {success}\n"
+                          "❌ Yuborilmadi: {failed}",
+    
+    "broadcast_cancelled": "⏹ Xabar yuborish to'xtatildi.\n\n"
+                           "✅ Yuborildi: {success}\n"
+                           "❌ Yuborilmadi: {failed}",
+    
     "channel_add": "➕ Kanal username yoki ID'sini kiriting:\n\n"
                    "Misol: @mychannel yoki -1001234567890",
     
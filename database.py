@@ -1,11 +1,480 @@
+import asyncio
+import heapq
+import logging
+import re
+import time
 import aiosqlite
-from datetime import datetime
-from config import DATABASE_PATH, DEFAULT_CHANNEL_ID
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from cache import TTLCache, MISSING
+from config import (
+    DATABASE_PATH, DEFAULT_CHANNEL_ID, ADMIN_IDS, DB_READ_CONNECTIONS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE,
+    USER_FLUSH_INTERVAL_MS, USER_FLUSH_MAX_PENDING,
+    MOVIE_CACHE_SIZE, MOVIE_CACHE_TTL, MOVIE_CACHE_NEGATIVE_TTL, STATS_CACHE_TTL,
+    STATS_FLUSH_INTERVAL_MS, POPULARITY_FLUSH_INTERVAL_MS, TOP_MOVIES_SIZE, MOVIE_CACHE_WARM,
+    INLINE_CACHE_SIZE, INLINE_CACHE_TTL, INLINE_MAX_RESULTS
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Long-lived SQLite connections: one writer and a few readers (WAL mode)"""
+
+    def __init__(self, path: str, readers: int = DB_READ_CONNECTIONS):
+        self.path = path
+        self.reader_count = max(1, readers)
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all = []
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.path)
+        db.row_factory = aiosqlite.Row
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        await db.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        self._all.append(db)
+        return db
+
+    async def open(self):
+        # Writer first so the WAL switch happens before readers attach
+        self._writer = await self._connect()
+        for _ in range(self.reader_count):
+            self._readers.put_nowait(await self._connect())
+
+    async def close(self):
+        for db in self._all:
+            await db.close()
+        self._all.clear()
+        self._writer = None
+        self._readers = asyncio.Queue()
+
+    @asynccontextmanager
+    async def reader(self):
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+
+class WriteBehindBuffer:
+    """Merges pending writes in memory and flushes them in one transaction
+
+    Subclasses fill self._pending (a dict keyed so repeated writes coalesce) and
+    implement _write(db, batch). Flushes run every interval_ms, or sooner once
+    max_pending keys are waiting, and once more on stop().
+    """
+
+    name = "buffer"
+
+    def __init__(self, interval_ms: int = USER_FLUSH_INTERVAL_MS, max_pending: int = USER_FLUSH_MAX_PENDING):
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def _added(self):
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    def _merge_back(self, batch: dict):
+        # Entries recorded while the failed flush was running are newer and win
+        for key, entry in batch.items():
+            self._pending.setdefault(key, entry)
+
+    async def _write(self, db, batch: dict):
+        raise NotImplementedError
+
+    async def flush(self):
+        """Write everything pending in one transaction, return what _write returns"""
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        try:
+            async with _writer() as db:
+                return await self._write(db, batch)
+        except BaseException:
+            self._merge_back(batch)
+            raise
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush {self.name}: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop and drain whatever is still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class UserActivityBuffer(WriteBehindBuffer):
+    """Coalesces user sightings and upserts them in batches"""
+
+    name = "user activity"
+
+    async def flush(self):
+        new_users = await super().flush()
+        if new_users:
+            counters['users'] += new_users
+            statistics_buffer.record(new_users=new_users)
+        return new_users
+
+    def record(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        now = datetime.now().isoformat()
+        seen = int(time.time())
+        # user_id -> [username, first_name, last_name, first_seen, last_active, last_seen, reactivate]
+        entry = self._pending.get(user_id)
+        if entry is None:
+            self._pending[user_id] = [username, first_name, last_name, now, now, seen, True]
+        else:
+            entry[0:3] = username, first_name, last_name
+            entry[4:7] = now, seen, True
+        # The user is talking to the bot again, so they are reachable
+        inactive_buffer.discard(user_id)
+        self._added()
+
+    def deactivate(self, user_id: int):
+        """A newer inactive mark wins over a pending sighting: don't reactivate on flush"""
+        entry = self._pending.get(user_id)
+        if entry is not None:
+            entry[6] = False
+
+    async def _write(self, db, batch: dict):
+        """Upsert the sightings, return number of new users"""
+        cursor = await db.executemany("""
+            INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date, last_active, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(uid, *entry[:6]) for uid, entry in batch.items()])
+        new_users = max(cursor.rowcount, 0)
+        await db.executemany("""
+            UPDATE users SET username = ?, first_name = ?, last_name = ?, last_active = ?, last_seen = ?,
+                is_active = CASE WHEN ? THEN 1 ELSE is_active END
+            WHERE user_id = ?
+        """, [(e[0], e[1], e[2], e[4], e[5], int(e[6]), uid) for uid, e in batch.items()])
+        return new_users
+
+
+class MembershipBuffer(WriteBehindBuffer):
+    """Coalesces channel membership verdicts (from chat_member updates or the API)"""
+
+    name = "channel memberships"
+
+    def record(self, channel_id: str, user_id: int, is_member: bool):
+        self._pending[(channel_id, user_id)] = (int(is_member), int(time.time()))
+        self._added()
+
+    def pending(self, channel_id: str, user_id: int):
+        entry = self._pending.get((channel_id, user_id))
+        return None if entry is None else bool(entry[0])
+
+    async def _write(self, db, batch: dict):
+        await db.executemany("""
+            INSERT INTO channel_members (channel_id, user_id, is_member, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(channel_id, user_id) DO UPDATE SET
+                is_member = excluded.is_member, updated_at = excluded.updated_at
+        """, [(cid, uid, m, ts) for (cid, uid), (m, ts) in batch.items()])
+        return len(batch)
+
+
+class InactiveUserBuffer(WriteBehindBuffer):
+    """Users that can no longer be messaged, marked is_active = 0 in batches"""
+
+    name = "inactive users"
+
+    def record(self, user_id: int):
+        self._pending[user_id] = None
+        self._added()
+
+    def discard(self, user_id: int):
+        self._pending.pop(user_id, None)
+
+    async def _write(self, db, batch: dict):
+        await db.executemany(
+            "UPDATE users SET is_active = 0 WHERE user_id = ?",
+            [(user_id,) for user_id in batch]
+        )
+        return len(batch)
+
+
+class MovieRequestBuffer(WriteBehindBuffer):
+    """Who received which movie, for broadcast segments; repeats coalesce"""
+
+    name = "movie requests"
+
+    def record(self, code: str, user_id: int):
+        self._pending[(code, user_id)] = int(time.time())
+        self._added()
+
+    async def _write(self, db, batch: dict):
+        await db.executemany("""
+            INSERT INTO movie_requests (code, user_id, requested_at) VALUES (?, ?, ?)
+            ON CONFLICT(code, user_id) DO UPDATE SET requested_at = excluded.requested_at
+        """, [(code, uid, ts) for (code, uid), ts in batch.items()])
+        return len(batch)
+
+
+class StatisticsBuffer(WriteBehindBuffer):
+    """Counts new users and movie deliveries per day, flushed into `statistics`"""
+
+    name = "daily statistics"
+
+    def record(self, new_users: int = 0, movies_sent: int = 0):
+        day = datetime.now().date().isoformat()
+        entry = self._pending.setdefault(day, [0, 0])
+        entry[0] += new_users
+        entry[1] += movies_sent
+
+    def _merge_back(self, batch: dict):
+        # Counters are deltas, so a failed batch is added back, not replaced
+        for day, (new_users, movies_sent) in batch.items():
+            entry = self._pending.setdefault(day, [0, 0])
+            entry[0] += new_users
+            entry[1] += movies_sent
+
+    async def _write(self, db, batch: dict):
+        await db.executemany("""
+            INSERT INTO statistics (date, new_users, movies_sent) VALUES (?, ?, ?)
+            ON CONFLICT(date) DO UPDATE SET
+                new_users = new_users + excluded.new_users,
+                movies_sent = movies_sent + excluded.movies_sent
+        """, [(day, n, m) for day, (n, m) in batch.items()])
+        return len(batch)
+
+    def pending(self):
+        return {day: tuple(entry) for day, entry in self._pending.items()}
+
+
+class PopularityBuffer(WriteBehindBuffer):
+    """Per-code delivery counters, flushed into movies.views"""
+
+    name = "movie views"
+
+    def record(self, code: str):
+        self._pending[code] = self._pending.get(code, 0) + 1
+        self._added()
+
+    def _merge_back(self, batch: dict):
+        for code, views in batch.items():
+            self._pending[code] = self._pending.get(code, 0) + views
+
+    async def _write(self, db, batch: dict):
+        """Add the counts, return {code: (views, title)} of the updated movies"""
+        await db.executemany(
+            "UPDATE movies SET views = views + ? WHERE code = ?",
+            [(views, code) for code, views in batch.items()]
+        )
+        codes = list(batch)
+        updated = {}
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(codes), 500):
+            chunk = codes[i:i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            async with db.execute(
+                f"SELECT code, views, title FROM movies WHERE code IN ({placeholders})", chunk
+            ) as cursor:
+                for code, views, title in await cursor.fetchall():
+                    updated[code] = (views, title)
+        return updated
+
+    async def flush(self):
+        updated = await super().flush()
+        if updated:
+            top_movies.update(updated)
+        return updated
+
+
+class TopMovies:
+    """Incrementally maintained top-N of movies by views
+
+    Views only grow, so merging freshly flushed totals into the current top-N
+    and keeping the N largest gives the same answer as re-sorting the table.
+    """
+
+    def __init__(self, size: int = TOP_MOVIES_SIZE):
+        self.size = size
+        self._top = {}  # code -> (views, title)
+        self._ranked = []
+        self._stale = False
+
+    def load(self, rows):
+        self._top = {code: (views, title) for code, views, title in rows}
+        self._stale = False
+        self._rank()
+
+    def update(self, views_by_code: dict):
+        merged = {**self._top, **views_by_code}
+        self._top = dict(heapq.nlargest(self.size, merged.items(), key=lambda item: item[1][0]))
+        self._rank()
+
+    def remove(self, code: str):
+        if self._top.pop(code, None) is not None:
+            # The next movie in line is unknown until reloaded
+            self._stale = True
+            self._rank()
+
+    def needs_refill(self):
+        return self._stale
+
+    def all(self):
+        """[(code, title, views)] most viewed first"""
+        return self._ranked
+
+    def _rank(self):
+        items = sorted(self._top.items(), key=lambda item: item[1][0], reverse=True)
+        self._ranked = [(code, title, views) for code, (views, title) in items if views > 0]
+
+
+_pool = None
+user_buffer = UserActivityBuffer()
+membership_buffer = MembershipBuffer()
+statistics_buffer = StatisticsBuffer(interval_ms=STATS_FLUSH_INTERVAL_MS)
+popularity_buffer = PopularityBuffer(interval_ms=POPULARITY_FLUSH_INTERVAL_MS)
+inactive_buffer = InactiveUserBuffer()
+movie_request_buffer = MovieRequestBuffer()
+top_movies = TopMovies()
+_buffers = (
+    user_buffer, membership_buffer, statistics_buffer, popularity_buffer, inactive_buffer,
+    movie_request_buffer
+)
+movie_cache = TTLCache(MOVIE_CACHE_SIZE, MOVIE_CACHE_TTL)
+
+
+class ChannelRegistry:
+    """In-process copy of mandatory_channels, kept in sync by add/delete_channel"""
+
+    def __init__(self):
+        self._by_id = {}
+        self._list = []
+        # Bumped on every change so dependent caches can tell the set changed
+        self.version = 0
+
+    def load(self, rows):
+        self._by_id = {row['id']: dict(row) for row in rows}
+        self._changed()
+
+    def add(self, channel: dict):
+        self._by_id[channel['id']] = channel
+        self._changed()
+
+    def remove(self, channel_id: str):
+        self._by_id = {k: v for k, v in self._by_id.items() if v['channel_id'] != channel_id}
+        self._changed()
+
+    def get(self, id: int):
+        return self._by_id.get(id)
+
+    def all(self):
+        return self._list
+
+    def resolve(self, chat_id: int, username: str = None):
+        """channel_id values of registered channels matching a Telegram chat"""
+        keys = {str(chat_id)}
+        if username:
+            keys.add(f"@{username}".lower())
+        return [c['channel_id'] for c in self._list if c['channel_id'].lower() in keys]
+
+    def _changed(self):
+        self._list = sorted(self._by_id.values(), key=lambda c: c['id'])
+        self.version += 1
+
+
+channel_registry = ChannelRegistry()
+
+# Row counts, loaded once by init_db and kept current by the write paths
+counters = {'users': 0, 'movies': 0}
+stats_cache = TTLCache(1, STATS_CACHE_TTL)
+inline_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+episode_cache = TTLCache(MOVIE_CACHE_SIZE, MOVIE_CACHE_TTL)  # code -> [(episode, file_id)]
+
+# Admins from the admins table, and their union with ADMIN_IDS from config.
+# Kept in sync by add_admin/delete_admin so admin checks never touch SQLite.
+_db_admin_ids = set()
+_admin_ids = set(ADMIN_IDS)
+
+
+async def open_db(path: str = DATABASE_PATH):
+    """Open the shared connection pool (call once on startup)"""
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(path)
+        await _pool.open()
+        for buffer in _buffers:
+            buffer.start()
+    return _pool
+
+
+async def close_db():
+    """Drain write-behind buffers and close the shared connection pool"""
+    global _pool
+    if _pool is not None:
+        for buffer in _buffers:
+            await buffer.stop()
+        await _pool.close()
+        _pool = None
+
+
+def _reader():
+    if _pool is None:
+        raise RuntimeError("Database is not open, call open_db() first")
+    return _pool.reader()
+
+
+def _writer():
+    if _pool is None:
+        raise RuntimeError("Database is not open, call open_db() first")
+    return _pool.writer()
+
+
+async def _add_column(db, table: str, column: str, definition: str):
+    """Add a column to an existing table; returns True if it was missing"""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if column in columns:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
 
 
 async def init_db():
     """Initialize database with required tables"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _writer() as db:
         # Users table
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -15,10 +484,27 @@ async def init_db():
                 last_name TEXT,
                 join_date TEXT,
                 last_active TEXT,
-                is_active INTEGER DEFAULT 1
+                is_active INTEGER DEFAULT 1,
+                last_seen INTEGER
             )
         """)
         
+        # last_seen: last_active as unix time, so activity windows are index range scans
+        if await _add_column(db, "users", "last_seen", "INTEGER"):
+            await db.execute("""
+                UPDATE users SET last_seen = CAST(strftime('%s', last_active, 'utc') AS INTEGER)
+                WHERE last_active IS NOT NULL
+            """)
+        # Partial indexes: broadcasts and activity stats only look at reachable users
+        await db.execute("DROP INDEX IF EXISTS idx_users_last_seen")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(user_id) WHERE is_active = 1")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_active_seen ON users(last_seen) WHERE is_active = 1"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_active_joined ON users(join_date) WHERE is_active = 1"
+        )
+        
         # Movies table
         await db.execute("""
             CREATE TABLE IF NOT EXISTS movies (
@@ -28,9 +514,60 @@ async def init_db():
                 title TEXT,
                 description TEXT,
                 added_by INTEGER,
-                added_date TEXT
+                added_date TEXT,
+                views INTEGER DEFAULT 0,
+                media_type TEXT DEFAULT 'video'
             )
         """)
+        await _add_column(db, "movies", "views", "INTEGER DEFAULT 0")
+        # 'video' or 'document': Telegram rejects a file_id sent as the wrong type
+        await _add_column(db, "movies", "media_type", "TEXT DEFAULT 'video'")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_movies_views ON movies(views)")
+        
+        # Full-text index over titles/descriptions, kept in sync by triggers
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'movies_fts'") as cursor:
+            fts_exists = await cursor.fetchone() is not None
+        await db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5(
+                title, description,
+                content='movies', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies BEGIN
+                INSERT INTO movies_fts (rowid, title, description)
+                VALUES (new.id, new.title, new.description);
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies BEGIN
+                INSERT INTO movies_fts (movies_fts, rowid, title, description)
+                VALUES ('delete', old.id, old.title, old.description);
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS movies_fts_update AFTER UPDATE OF title, description ON movies BEGIN
+                INSERT INTO movies_fts (movies_fts, rowid, title, description)
+                VALUES ('delete', old.id, old.title, old.description);
+                INSERT INTO movies_fts (rowid, title, description)
+                VALUES (new.id, new.title, new.description);
+            END
+        """)
+        if not fts_exists:
+            # Index movies added before the FTS table existed
+            await db.execute("INSERT INTO movies_fts (movies_fts) VALUES ('rebuild')")
+        
+        # Series episodes, attached to a movie code
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS episodes (
+                movie_code TEXT NOT NULL,
+                episode INTEGER NOT NULL,
+                file_id TEXT NOT NULL,
+                added_date TEXT,
+                PRIMARY KEY (movie_code, episode)
+            ) WITHOUT ROWID
+        """)
         
         # Mandatory channels table
         await db.execute("""
@@ -51,6 +588,7 @@ async def init_db():
                 movies_sent INTEGER DEFAULT 0
             )
         """)
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_statistics_date ON statistics(date)")
         
         # Admins table
         await db.execute("""
@@ -62,7 +600,78 @@ async def init_db():
             )
         """)
         
-        await db.commit()
+        # Channel membership, fed by chat_member updates and API fallbacks
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS channel_members (
+                channel_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                is_member INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY (user_id, channel_id)
+            ) WITHOUT ROWID
+        """)
+        
+        # Movie deliveries per user (broadcast segment "requested a movie")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS movie_requests (
+                code TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                requested_at INTEGER NOT NULL,
+                PRIMARY KEY (code, user_id)
+            ) WITHOUT ROWID
+        """)
+        
+        # FSM conversations (storage.SQLiteStorage); data is compact JSON
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)")
+        
+        # Broadcast jobs; cursor is the last user_id whose delivery is done
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                from_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                progress_message_id INTEGER,
+                total INTEGER DEFAULT 0,
+                cursor INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                created_at TEXT,
+                finished_at TEXT,
+                segment TEXT DEFAULT 'all',
+                segment_value TEXT
+            )
+        """)
+        await _add_column(db, "broadcasts", "segment", "TEXT DEFAULT 'all'")
+        await _add_column(db, "broadcasts", "segment_value", "TEXT")
+        
+        async with db.execute("SELECT * FROM mandatory_channels") as cursor:
+            channel_registry.load(await cursor.fetchall())
+        
+        async with db.execute("""
+            SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM movies)
+        """) as cursor:
+            counters['users'], counters['movies'] = await cursor.fetchone()
+        
+        async with db.execute(
+            "SELECT code, views, title FROM movies ORDER BY views DESC LIMIT ?", (top_movies.size,)
+        ) as cursor:
+            top_movies.load(await cursor.fetchall())
+        
+        async with db.execute("SELECT user_id FROM admins") as cursor:
+            _db_admin_ids.clear()
+            _db_admin_ids.update(row[0] for row in await cursor.fetchall())
+        _admin_ids.clear()
+        _admin_ids.update(ADMIN_IDS, _db_admin_ids)
 
 
 async def init_default_channel():
@@ -75,153 +684,598 @@ async def init_default_channel():
 
 # User functions
 async def add_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    """Add a new user to the database"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        now = datetime.now().isoformat()
-        try:
-            await db.execute("""
-                INSERT INTO users (user_id, username, first_name, last_name, join_date, last_active)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, username, first_name, last_name, now, now))
-            await db.commit()
-            return True
-        except aiosqlite.IntegrityError:
-            # User already exists, update last_active
-            await db.execute("""
-                UPDATE users SET last_active = ? WHERE user_id = ?
-            """, (now, user_id))
-            await db.commit()
-            return False
+    """Record a user sighting; written to the database by the write-behind buffer"""
+    user_buffer.record(user_id, username, first_name, last_name)
 
 
-async def get_all_users():
-    """Get all users from database"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM users") as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+# Broadcast audiences: segment -> SQL condition on users taking segment_value.
+# Each one is served by an index: the active_seen / active_joined partial
+# indexes for counts, the movie_requests primary key for movie segments.
+SEGMENTS = {
+    'all': "",
+    'active': " AND last_seen >= ?",  # segment_value: unix time cutoff
+    'joined': " AND join_date >= ?",  # segment_value: ISO date
+    'movie': " AND user_id IN (SELECT user_id FROM movie_requests WHERE code = ?)",
+}
+
+
+def _segment_filter(segment: str = 'all', value=None):
+    """(SQL condition, args) selecting reachable users of a broadcast segment"""
+    # Inactive users (blocked the bot, deleted account) are never recipients
+    condition = " AND is_active = 1" + SEGMENTS[segment]
+    if segment == 'all':
+        return condition, ()
+    if segment == 'active':
+        value = int(value)
+    return condition, (value,)
+
+
+async def count_segment_users(segment: str = 'all', value=None):
+    """Recipient count of a broadcast segment (preview before sending)"""
+    condition, args = _segment_filter(segment, value)
+    async with _reader() as db:
+        async with db.execute(f"SELECT COUNT(*) FROM users WHERE 1 = 1{condition}", args) as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def iter_segment_pages(segment: str = 'all', value=None, after_id: int = 0, page_size: int = 500):
+    """Stream a broadcast segment's user_ids in keyset pages, resumable from after_id"""
+    condition, args = _segment_filter(segment, value)
+    sql = f"SELECT user_id FROM users WHERE user_id > ?{condition} ORDER BY user_id LIMIT ?"
+    while True:
+        # Connection is only held while a page is read, not while it's consumed
+        async with _reader() as db:
+            async with db.execute(sql, (after_id, *args, page_size)) as cursor:
+                cursor.row_factory = None
+                page = [row[0] for row in await cursor.fetchall()]
+        if not page:
+            return
+        yield page
+        after_id = page[-1]
+
+
+async def _fetch_users(db, after_id: int = None, before_id: int = None, limit: int = 10):
+    # Keyset pagination on the user_id primary key: cost depends on the page
+    # size, not on how far into the table the page is
+    if before_id is not None:
+        sql = "SELECT user_id, username, first_name FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?"
+        args = (before_id, limit)
+    else:
+        sql = "SELECT user_id, username, first_name FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+        args = (after_id or 0, limit)
+    async with db.execute(sql, args) as cursor:
+        cursor.row_factory = None  # plain tuples
+        rows = await cursor.fetchall()
+    return rows[::-1] if before_id is not None else rows
+
+
+async def get_users_page(after_id: int = 0, before_id: int = None, limit: int = 10):
+    """One page of users for the admin list: (rows, has_previous, has_next)"""
+    async with _reader() as db:
+        rows = await _fetch_users(db, after_id=after_id, before_id=before_id, limit=limit + 1)
+        if before_id is not None:
+            has_previous = len(rows) > limit
+            rows = rows[-limit:]
+            has_next = True
+        else:
+            has_next = len(rows) > limit
+            rows = rows[:limit]
+            has_previous = False
+            if rows and after_id:
+                async with db.execute("SELECT 1 FROM users WHERE user_id < ? LIMIT 1", (rows[0][0],)) as cursor:
+                    has_previous = await cursor.fetchone() is not None
+    return rows, has_previous, has_next
 
 
 async def get_user_count():
-    """Get total user count"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+    """Get total user count (maintained counter, no COUNT(*))"""
+    return counters['users']
 
 
-async def get_active_user_count():
-    """Get active user count (last 7 days)"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("""
-            SELECT COUNT(*) FROM users 
-            WHERE datetime(last_active) > datetime('now', '-7 days')
-        """) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+async def get_active_user_counts(windows=(1, 7, 30)):
+    """Users active within each window of days, {days: count}, in one index range scan"""
+    now = int(time.time())
+    cutoffs = [now - days * 86400 for days in windows]
+    sums = ", ".join("SUM(last_seen >= ?)" for _ in cutoffs)
+    async with _reader() as db:
+        async with db.execute(
+            f"SELECT {sums} FROM users WHERE last_seen >= ? AND is_active = 1",
+            (*cutoffs, min(cutoffs))
+        ) as cursor:
+            row = await cursor.fetchone()
+    return {days: (count or 0) for days, count in zip(windows, row)}
+
+
+def mark_user_inactive(user_id: int):
+    """Queue a user who blocked the bot or no longer exists for is_active = 0"""
+    # The buffers flush independently; the newest event must win
+    user_buffer.deactivate(user_id)
+    inactive_buffer.record(user_id)
+
+
+async def get_active_user_count(days: int = 7):
+    """Get active user count (last `days` days)"""
+    counts = await get_active_user_counts((days,))
+    return counts[days]
+
+
+async def get_stats():
+    """Admin dashboard numbers, served from a short-lived snapshot"""
+    stats = stats_cache.get('stats')
+    if stats is not MISSING:
+        return stats
+    
+    active = await get_active_user_counts((1, 7, 30))
+    stats = {
+        'total_users': counters['users'],
+        'active_1d': active[1],
+        'active_users': active[7],
+        'active_30d': active[30],
+        'total_movies': counters['movies'],
+        'total_channels': len(channel_registry.all()),
+    }
+    stats_cache.set('stats', stats)
+    return stats
+
+
+def record_movie_sent(code: str, user_id: int = None):
+    """Count a movie delivery (daily statistics, per-movie views and requesters)"""
+    statistics_buffer.record(movies_sent=1)
+    popularity_buffer.record(code)
+    if user_id is not None:
+        movie_request_buffer.record(code, user_id)
+
+
+async def get_top_movies(limit: int = TOP_MOVIES_SIZE):
+    """Most viewed movies as (code, title, views), most viewed first"""
+    if top_movies.needs_refill():
+        # A top movie was deleted; refill from the views index
+        async with _reader() as db:
+            async with db.execute(
+                "SELECT code, views, title FROM movies ORDER BY views DESC LIMIT ?", (top_movies.size,)
+            ) as cursor:
+                top_movies.load(await cursor.fetchall())
+    return top_movies.all()[:limit]
+
+
+async def warm_movie_cache(limit: int = MOVIE_CACHE_WARM):
+    """Pre-load the most viewed movies into movie_cache"""
+    async with _reader() as db:
+        async with db.execute("SELECT * FROM movies ORDER BY views DESC LIMIT ?", (limit,)) as cursor:
+            rows = await cursor.fetchall()
+    for row in rows:
+        movie_cache.set(row['code'], dict(row))
+    return len(rows)
+
+
+async def get_daily_statistics(days: int = 7):
+    """Per-day (date, new_users, movies_sent) for the last `days` days, newest first"""
+    since = (datetime.now().date() - timedelta(days=days - 1)).isoformat()
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT date, new_users, movies_sent FROM statistics WHERE date >= ? ORDER BY date DESC",
+            (since,)
+        ) as cursor:
+            rows = {row[0]: [row[1], row[2]] for row in await cursor.fetchall()}
+    # Add what is still waiting to be flushed
+    for day, (new_users, movies_sent) in statistics_buffer.pending().items():
+        if day >= since:
+            entry = rows.setdefault(day, [0, 0])
+            entry[0] += new_users
+            entry[1] += movies_sent
+    return [(day, *rows[day]) for day in sorted(rows, reverse=True)]
 
 
 # Movie functions
-async def add_movie(code: str, file_id: str, title: str = None, description: str = None, added_by: int = None):
+async def add_movie(code: str, file_id: str, title: str = None, description: str = None, added_by: int = None,
+                    media_type: str = 'video'):
     """Add a new movie to the database"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        now = datetime.now().isoformat()
-        try:
+    try:
+        async with _writer() as db:
+            now = datetime.now().isoformat()
             await db.execute("""
-                INSERT INTO movies (code, file_id, title, description, added_by, added_date)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (code.upper(), file_id, title, description, added_by, now))
-            await db.commit()
-            return True
-        except aiosqlite.IntegrityError:
-            return False
+                INSERT INTO movies (code, file_id, title, description, added_by, added_date, media_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (code.upper(), file_id, title, description, added_by, now, media_type))
+    except aiosqlite.IntegrityError:
+        return False
+    movie_cache.invalidate(code.upper())
+    inline_cache.clear()
+    counters['movies'] += 1
+    return True
+
+
+async def add_movies_bulk(rows, added_by: int = None):
+    """Insert (code, file_id, title, description, media_type) rows in one transaction
+
+    Returns (inserted, duplicate_codes); codes that already exist, or repeat
+    within `rows`, are skipped and reported instead of aborting the batch.
+    Callers refresh movie_cache once when the whole import is done.
+    """
+    now = datetime.now().isoformat()
+    unique = {}
+    duplicates = []
+    for code, file_id, title, description, media_type in rows:
+        code = code.upper()
+        if code in unique:
+            duplicates.append(code)
+        else:
+            unique[code] = (code, file_id, title, description, added_by, now, media_type)
+    
+    async with _writer() as db:
+        codes = list(unique)
+        for i in range(0, len(codes), 500):
+            chunk = codes[i:i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            async with db.execute(f"SELECT code FROM movies WHERE code IN ({placeholders})", chunk) as cursor:
+                for row in await cursor.fetchall():
+                    duplicates.append(row[0])
+                    del unique[row[0]]
+        # rowcount, not total_changes: the FTS triggers count as changes too
+        cursor = await db.executemany("""
+            INSERT OR IGNORE INTO movies (code, file_id, title, description, added_by, added_date, media_type)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, list(unique.values()))
+        inserted = max(cursor.rowcount, 0)
+    
+    counters['movies'] += inserted
+    if inserted:
+        inline_cache.clear()
+    return inserted, duplicates
 
 
 async def get_movie_by_code(code: str):
-    """Get movie by code"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM movies WHERE code = ?", (code.upper(),)) as cursor:
+    """Get movie by code (served from movie_cache when possible)"""
+    code = code.upper()
+    movie = movie_cache.get(code)
+    if movie is not MISSING:
+        return movie
+    
+    generation = movie_cache.generation
+    async with _reader() as db:
+        async with db.execute("SELECT * FROM movies WHERE code = ?", (code,)) as cursor:
             row = await cursor.fetchone()
-            return dict(row) if row else None
+    
+    movie = dict(row) if row else None
+    ttl = MOVIE_CACHE_TTL if movie else MOVIE_CACHE_NEGATIVE_TTL
+    movie_cache.set(code, movie, ttl=ttl, generation=generation)
+    return movie
+
+
+async def get_movies_by_codes(codes):
+    """Look up several codes at once: cache first, then one IN (...) query
+
+    Returns {code: movie or None} for every (upper-cased) code.
+    """
+    result = {}
+    missing = []
+    for code in codes:
+        code = code.upper()
+        movie = movie_cache.get(code)
+        if movie is MISSING:
+            missing.append(code)
+        else:
+            result[code] = movie
+    
+    if missing:
+        generation = movie_cache.generation
+        placeholders = ", ".join("?" * len(missing))
+        async with _reader() as db:
+            async with db.execute(f"SELECT * FROM movies WHERE code IN ({placeholders})", missing) as cursor:
+                found = {row['code']: dict(row) for row in await cursor.fetchall()}
+        for code in missing:
+            movie = found.get(code)
+            ttl = MOVIE_CACHE_TTL if movie else MOVIE_CACHE_NEGATIVE_TTL
+            movie_cache.set(code, movie, ttl=ttl, generation=generation)
+            result[code] = movie
+    
+    return result
+
+
+def _fts_query(text: str, operator: str):
+    # Each word becomes a quoted prefix term, so user input can't inject FTS syntax
+    words = re.findall(r"\w+", text.lower())[:8]
+    return f" {operator} ".join(f'"{word}"*' for word in words)
+
+
+async def search_movies(text: str, limit: int = 5):
+    """Best matching movies for a title search, best first"""
+    query = _fts_query(text, "AND")
+    if not query:
+        return []
+    async with _reader() as db:
+        # All words first; if nothing matches, any of the words
+        for match in (query, _fts_query(text, "OR")):
+            async with db.execute("""
+                SELECT m.code, m.file_id, m.title, m.description, m.media_type FROM movies_fts
+                JOIN movies m ON m.id = movies_fts.rowid
+                WHERE movies_fts MATCH ?
+                ORDER BY movies_fts.rank
+                LIMIT ?
+            """, (match, limit)) as cursor:
+                rows = await cursor.fetchall()
+            if rows:
+                return [dict(row) for row in rows]
+    return []
+
+
+def _inline_key(query: str):
+    return " ".join(query.lower().split())
+
+
+def forget_inline_results(query: str):
+    """Drop a cached inline result list (e.g. one Telegram refused)"""
+    inline_cache.invalidate(_inline_key(query))
+
+
+async def get_inline_results(query: str):
+    """Movies for an inline query, cached per normalized query text
+
+    An exact code match comes first, then title matches; an empty query (or
+    one matching nothing, e.g. the share button's text) lists the top movies.
+    """
+    key = _inline_key(query)
+    movies = inline_cache.get(key)
+    if movies is not MISSING:
+        return movies
+    
+    generation = inline_cache.generation
+    movies = []
+    if key:
+        exact = await get_movie_by_code(key)
+        if exact:
+            movies.append(exact)
+        movies += [m for m in await search_movies(key, INLINE_MAX_RESULTS) if not exact or m['code'] != exact['code']]
+    if not movies:
+        for code, title, views in await get_top_movies():
+            movie = await get_movie_by_code(code)
+            if movie:
+                movies.append(movie)
+    
+    inline_cache.set(key, movies, generation=generation)
+    return movies
 
 
 async def get_movie_count():
-    """Get total movie count"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM movies") as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+    """Get total movie count (maintained counter, no COUNT(*))"""
+    return counters['movies']
 
 
 async def delete_movie(code: str):
     """Delete a movie by code"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("DELETE FROM movies WHERE code = ?", (code.upper(),))
-        await db.commit()
+    async with _writer() as db:
+        cursor = await db.execute("DELETE FROM movies WHERE code = ?", (code.upper(),))
+        deleted = cursor.rowcount
+        await db.execute("DELETE FROM episodes WHERE movie_code = ?", (code.upper(),))
+    episode_cache.invalidate(code.upper())
+    movie_cache.invalidate(code.upper())
+    inline_cache.clear()
+    top_movies.remove(code.upper())
+    counters['movies'] -= deleted
+
+
+# Episode functions
+async def add_episodes(code: str, file_ids):
+    """Append episodes to a series in one transaction, return (first, last) numbers"""
+    code = code.upper()
+    now = datetime.now().isoformat()
+    async with _writer() as db:
+        async with db.execute("SELECT COALESCE(MAX(episode), 0) FROM episodes WHERE movie_code = ?", (code,)) as cursor:
+            last = (await cursor.fetchone())[0]
+        await db.executemany(
+            "INSERT INTO episodes (movie_code, episode, file_id, added_date) VALUES (?, ?, ?, ?)",
+            [(code, last + i, file_id, now) for i, file_id in enumerate(file_ids, 1)]
+        )
+    episode_cache.invalidate(code)
+    return last + 1, last + len(file_ids)
+
+
+async def get_episodes(code: str):
+    """Episodes of a series as [(episode, file_id)]; empty for a plain movie"""
+    code = code.upper()
+    episodes = episode_cache.get(code)
+    if episodes is not MISSING:
+        return episodes
+    
+    generation = episode_cache.generation
+    async with _reader() as db:
+        # Primary key range scan
+        async with db.execute(
+            "SELECT episode, file_id FROM episodes WHERE movie_code = ? ORDER BY episode", (code,)
+        ) as cursor:
+            episodes = [(row[0], row[1]) for row in await cursor.fetchall()]
+    episode_cache.set(code, episodes, generation=generation)
+    return episodes
 
 
 # Channel functions
 async def add_channel(channel_id: str, channel_username: str = None):
     """Add a mandatory channel"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        now = datetime.now().isoformat()
-        try:
-            await db.execute("""
+    now = datetime.now().isoformat()
+    try:
+        async with _writer() as db:
+            cursor = await db.execute("""
                 INSERT INTO mandatory_channels (channel_id, channel_username, added_date)
                 VALUES (?, ?, ?)
             """, (channel_id, channel_username, now))
-            await db.commit()
-            return True
-        except aiosqlite.IntegrityError:
-            return False
+            row_id = cursor.lastrowid
+    except aiosqlite.IntegrityError:
+        return False
+    channel_registry.add({
+        'id': row_id,
+        'channel_id': channel_id,
+        'channel_username': channel_username,
+        'added_date': now,
+    })
+    return True
 
 
 async def get_all_channels():
-    """Get all mandatory channels"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM mandatory_channels") as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+    """Get all mandatory channels (from the in-process registry)"""
+    return channel_registry.all()
+
+
+async def get_channel(id: int):
+    """Get a mandatory channel by its row id"""
+    return channel_registry.get(id)
 
 
 async def delete_channel(channel_id: str):
     """Delete a mandatory channel"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _writer() as db:
         await db.execute("DELETE FROM mandatory_channels WHERE channel_id = ?", (channel_id,))
-        await db.commit()
+        await db.execute("DELETE FROM channel_members WHERE channel_id = ?", (channel_id,))
+    channel_registry.remove(channel_id)
 
 
 async def get_channel_count():
     """Get total channel count"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM mandatory_channels") as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+    return len(channel_registry.all())
+
+
+# Channel membership functions
+def record_membership(channel_id: str, user_id: int, is_member: bool):
+    """Queue a membership verdict for the channel_members table"""
+    membership_buffer.record(channel_id, user_id, is_member)
+
+
+async def get_memberships(user_id: int, channel_ids, max_age: int):
+    """Known membership verdicts of a user, {channel_id: is_member}, newer than max_age seconds"""
+    result = {}
+    cutoff = int(time.time()) - max_age
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT channel_id, is_member FROM channel_members WHERE user_id = ? AND updated_at >= ?",
+            (user_id, cutoff)
+        ) as cursor:
+            for channel_id, is_member in await cursor.fetchall():
+                result[channel_id] = bool(is_member)
+    # Verdicts still waiting in the write-behind buffer are the freshest
+    for channel_id in channel_ids:
+        pending = membership_buffer.pending(channel_id, user_id)
+        if pending is not None:
+            result[channel_id] = pending
+    return {cid: result[cid] for cid in channel_ids if cid in result}
+
+
+# Broadcast functions
+async def create_broadcast(admin_id: int, from_chat_id: int, message_id: int, progress_message_id: int, total: int,
+                           segment: str = 'all', segment_value=None):
+    """Create a broadcast job and return its id"""
+    async with _writer() as db:
+        cursor = await db.execute("""
+            INSERT INTO broadcasts (
+                admin_id, from_chat_id, message_id, progress_message_id, total, created_at, segment, segment_value
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            admin_id, from_chat_id, message_id, progress_message_id, total, datetime.now().isoformat(),
+            segment, segment_value
+        ))
+        return cursor.lastrowid
+
+
+async def get_broadcast(job_id: int):
+    """Get a broadcast job by id"""
+    async with _reader() as db:
+        async with db.execute("SELECT * FROM broadcasts WHERE id = ?", (job_id,)) as cursor:
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+
+
+async def get_running_broadcasts():
+    """Broadcast jobs that have not finished (to resume after a restart)"""
+    async with _reader() as db:
+        async with db.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id") as cursor:
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+
+async def save_broadcast_progress(job_id: int, cursor_id: int, sent: int, failed: int):
+    """Persist how far a broadcast got"""
+    async with _writer() as db:
+        await db.execute(
+            "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ? WHERE id = ?",
+            (cursor_id, sent, failed, job_id)
+        )
+
+
+async def finish_broadcast(job_id: int, status: str = 'done'):
+    """Mark a broadcast as done or cancelled"""
+    async with _writer() as db:
+        await db.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?",
+            (status, datetime.now().isoformat(), job_id)
+        )
+
+
+# FSM storage functions
+async def get_fsm_record(key: str, max_age: int):
+    """(state, data JSON, updated_at) of a conversation updated within max_age seconds, or None"""
+    async with _reader() as db:
+        async with db.execute(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ? AND updated_at >= ?",
+            (key, int(time.time()) - max_age)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return tuple(row) if row else None
+
+
+async def _save_fsm(key: str, column: str, value, max_age: int):
+    other = "data" if column == "state" else "state"
+    now = int(time.time())
+    async with _writer() as db:
+        # An expired row not swept yet must not lend its other column to the new conversation
+        await db.execute(f"""
+            INSERT INTO fsm_states (key, {column}, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                {column} = excluded.{column},
+                {other} = CASE WHEN updated_at < ? THEN NULL ELSE {other} END,
+                updated_at = excluded.updated_at
+        """, (key, value, now, now - max_age))
+        # A finished conversation leaves no row behind
+        await db.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data IS NULL", (key,))
+
+
+async def save_fsm_state(key: str, state: str, max_age: int):
+    """Set (or clear, with None) a conversation's state"""
+    await _save_fsm(key, "state", state, max_age)
+
+
+async def save_fsm_data(key: str, data: str, max_age: int):
+    """Replace a conversation's data JSON (None clears it)"""
+    await _save_fsm(key, "data", data, max_age)
+
+
+async def delete_stale_fsm(max_age: int):
+    """Drop conversations idle for longer than max_age seconds, return how many"""
+    async with _writer() as db:
+        cursor = await db.execute(
+            "DELETE FROM fsm_states WHERE updated_at < ?", (int(time.time()) - max_age,)
+        )
+        return cursor.rowcount
 
 
 # Admin functions
 async def add_admin(user_id: int, username: str = None, added_by: int = None):
     """Add a new admin"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        now = datetime.now().isoformat()
-        try:
+    now = datetime.now().isoformat()
+    try:
+        async with _writer() as db:
             await db.execute("""
                 INSERT INTO admins (user_id, username, added_by, added_date)
                 VALUES (?, ?, ?, ?)
             """, (user_id, username, added_by, now))
-            await db.commit()
-            return True
-        except aiosqlite.IntegrityError:
-            return False
+    except aiosqlite.IntegrityError:
+        return False
+    _db_admin_ids.add(user_id)
+    _admin_ids.add(user_id)
+    return True
 
 
 async def get_all_admins():
     """Get all admins from database"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _reader() as db:
         async with db.execute("SELECT * FROM admins") as cursor:
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
@@ -229,14 +1283,18 @@ async def get_all_admins():
 
 async def delete_admin(user_id: int):
     """Delete an admin"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _writer() as db:
         await db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-        await db.commit()
+    _db_admin_ids.discard(user_id)
+    if user_id not in ADMIN_IDS:
+        _admin_ids.discard(user_id)
 
 
 async def is_admin_in_db(user_id: int):
-    """Check if user is admin in database"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT user_id FROM admins WHERE user_id = ?", (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result is not None
+    """Check if user is admin in database (in-memory set)"""
+    return user_id in _db_admin_ids
+
+
+def is_admin_user(user_id: int) -> bool:
+    """Check if user is a config or database admin (in-memory set)"""
+    return user_id in _admin_ids
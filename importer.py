@@ -0,0 +1,85 @@
+import codecs
+import csv
+import json
+import logging
+
+from config import IMPORT_CHUNK_SIZE
+from database import add_movies_bulk, movie_cache, warm_movie_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _lines(binary_file):
+    """Decode a binary file line by line without reading it whole"""
+    return codecs.iterdecode(binary_file, "utf-8-sig")
+
+
+def parse_rows(binary_file, filename: str = ""):
+    """Yield (line_number, row_dict) from a CSV or JSONL file, streaming"""
+    lines = _lines(binary_file)
+    if filename.lower().endswith((".jsonl", ".json", ".ndjson")):
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else None
+    else:
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, {key.strip().lower(): value for key, value in row.items() if key}
+
+
+def _clean(row):
+    """(code, file_id, title, description, media_type) or None if the row is unusable"""
+    if not row:
+        return None
+    code = str(row.get("code") or "").strip()
+    file_id = str(row.get("file_id") or "").strip()
+    if not code or not file_id:
+        return None
+    title = str(row.get("title") or "").strip() or None
+    description = str(row.get("description") or "").strip() or None
+    # Optional column; anything but "document" is a video
+    media_type = "document" if str(row.get("type") or "").strip().lower() == "document" else "video"
+    return code, file_id, title, description, media_type
+
+
+async def import_movies(binary_file, filename: str, added_by: int = None):
+    """Stream movies from a file into the database in chunked transactions
+
+    Returns {'inserted': int, 'duplicates': [codes], 'invalid': [line numbers]}.
+    """
+    result = {'inserted': 0, 'duplicates': [], 'invalid': []}
+    chunk = []
+
+    async def flush():
+        inserted, duplicates = await add_movies_bulk(chunk, added_by)
+        result['inserted'] += inserted
+        result['duplicates'].extend(duplicates)
+        chunk.clear()
+
+    try:
+        for number, row in parse_rows(binary_file, filename):
+            movie = _clean(row)
+            if movie is None:
+                result['invalid'].append(number)
+                continue
+            chunk.append(movie)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                await flush()
+        if chunk:
+            await flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        logger.error(f"Import stopped, file could not be parsed: {e}")
+        result['invalid'].append("file")
+    finally:
+        # One refresh for the whole import: drops cached misses for the new codes
+        if result['inserted']:
+            movie_cache.clear()
+            await warm_movie_cache()
+
+    return result
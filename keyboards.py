@@ -16,6 +16,10 @@ def get_admin_keyboard():
     keyboard = [
         [
             InlineKeyboardButton(text="📊 Statistika", callback_data="admin_stats"),
+            InlineKeyboardButton(text="📈 Kunlik statistika", callback_data="daily_stats_7")
+        ],
+        [
+            InlineKeyboardButton(text="🔥 Top kinolar", callback_data="admin_top_movies"),
             InlineKeyboardButton(text="➕ Kanal qo'shish", callback_data="admin_add_channel")
         ],
         [
@@ -26,6 +30,13 @@ def get_admin_keyboard():
             InlineKeyboardButton(text="➕ Kino qo'shish", callback_data="admin_add_movie"),
             InlineKeyboardButton(text="🗑 Kino o'chirish", callback_data="admin_delete_movie")
         ],
+        [
+            InlineKeyboardButton(text="🔗 Kino havolasi", callback_data="admin_movie_link")
+        ],
+        [
+            InlineKeyboardButton(text="📥 Kino import", callback_data="admin_import_movies"),
+            InlineKeyboardButton(text="📺 Qism qo'shish", callback_data="admin_add_episodes")
+        ],
         [
             InlineKeyboardButton(text="�‍💼 Admin qo'shish", callback_data="admin_add_admin"),
             InlineKeyboardButton(text="👥 Adminlar", callback_data="admin_list_admins")
@@ -104,3 +115,69 @@ def get_movie_keyboard():
         ]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_broadcast_progress_keyboard(job_id):
+    """Stop button under a running broadcast's progress message"""
+    keyboard = [[InlineKeyboardButton(text="⏹ To'xtatish", callback_data=f"broadcast_cancel_{job_id}")]]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_broadcast_segments_keyboard():
+    """Audience choice for a broadcast"""
+    keyboard = [
+        [InlineKeyboardButton(text="👥 Hammaga", callback_data="broadcast_to_all")],
+        [
+            InlineKeyboardButton(text="🟢 24 soat", callback_data="broadcast_to_active_1"),
+            InlineKeyboardButton(text="🟢 7 kun", callback_data="broadcast_to_active_7"),
+            InlineKeyboardButton(text="🟢 30 kun", callback_data="broadcast_to_active_30")
+        ],
+        [InlineKeyboardButton(text="📅 Sanadan keyin qo'shilganlar", callback_data="broadcast_to_joined")],
+        [InlineKeyboardButton(text="🎬 Kino so'raganlar", callback_data="broadcast_to_movie")],
+        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_users_page_keyboard(first_id, last_id, has_previous, has_next):
+    """Previous/next navigation for the admin users list"""
+    nav = []
+    if has_previous:
+        nav.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=f"users_prev_{first_id}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"users_next_{last_id}"))
+    
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton(text="🔙 Ortga", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_daily_stats_keyboard():
+    """Period switch for the daily statistics view"""
+    keyboard = [
+        [
+            InlineKeyboardButton(text="7 kun", callback_data="daily_stats_7"),
+            InlineKeyboardButton(text="30 kun", callback_data="daily_stats_30")
+        ],
+        [InlineKeyboardButton(text="🔙 Ortga", callback_data="admin_panel")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_search_results_keyboard(movies):
+    """One button per suggested movie"""
+    keyboard = [
+        [InlineKeyboardButton(text=f"🎬 {movie['title'] or 'Kino'} ({movie['code']})", callback_data=f"movie_{movie['code']}")]
+        for movie in movies
+        if len(f"movie_{movie['code']}".encode()) <= 64  # callback_data limit
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_episodes_done_keyboard():
+    """Finish or cancel episode uploads"""
+    keyboard = [
+        [InlineKeyboardButton(text="✅ Tayyor", callback_data="episodes_done")],
+        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
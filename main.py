@@ -1,26 +1,46 @@
 import asyncio
 import logging
 import os
+import re
+import tempfile
+import time
+from datetime import datetime
 from aiohttp import web
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, CallbackQuery
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import (
+    Message, CallbackQuery, ChatMemberUpdated, InlineQuery,
+    InlineQueryResultCachedVideo, InlineQueryResultCachedDocument, InlineQueryResultsButton, InputMediaVideo
+)
+from aiogram.utils.deep_linking import create_start_link, decode_payload
+from aiogram.webhook.aiohttp_server import setup_application
 
-from config import BOT_TOKEN, ADMIN_IDS, MESSAGES
+from config import (
+    BOT_TOKEN, ADMIN_IDS, MESSAGES, INLINE_CACHE_TIME, MULTI_CODE_LIMIT, SERIES_GROUP_DELAY
+)
 from database import (
-    init_db, add_user, get_movie_by_code, add_movie, delete_movie,
-    add_channel, get_all_channels, delete_channel, get_all_users,
-    get_user_count, get_active_user_count, get_movie_count, get_channel_count,
-    init_default_channel, add_admin, get_all_admins, delete_admin, is_admin_in_db
+    open_db, close_db, init_db, add_user, get_movie_by_code, add_movie, delete_movie,
+    add_channel, get_all_channels, get_channel, delete_channel, get_users_page,
+    get_user_count, get_stats, get_daily_statistics, record_movie_sent, count_segment_users,
+    get_top_movies, warm_movie_cache, search_movies, get_inline_results, get_movies_by_codes,
+    forget_inline_results,
+    add_episodes, get_episodes,
+    init_default_channel, add_admin, get_all_admins, delete_admin, is_admin_in_db,
+    is_admin_user
 )
-from middleware import check_user_subscription, get_subscription_keyboard
+from importer import import_movies
+from storage import SQLiteStorage
+from updates import QueuedRequestHandler
+from broadcast import start_broadcast, cancel_broadcast, resume_broadcasts, stop_broadcasts
+from middleware import check_user_subscription, get_subscription_keyboard, handle_member_update
 from keyboards import (
     get_admin_keyboard, get_channels_keyboard, get_back_keyboard, get_cancel_keyboard,
-    get_main_keyboard, get_admins_keyboard, get_movie_keyboard
+    get_main_keyboard, get_admins_keyboard, get_movie_keyboard, get_users_page_keyboard,
+    get_daily_stats_keyboard, get_search_results_keyboard, get_episodes_done_keyboard,
+    get_broadcast_segments_keyboard
 )
 
 # Configure logging
@@ -33,7 +53,7 @@ from aiogram.client.session.aiohttp import AiohttpSession
 
 session = AiohttpSession(timeout=60)  # 60 seconds timeout
 bot = Bot(token=BOT_TOKEN, session=session)
-storage = MemoryStorage()
+storage = SQLiteStorage()  # admin conversations survive restarts
 dp = Dispatcher(storage=storage)
 
 
@@ -41,59 +61,219 @@ dp = Dispatcher(storage=storage)
 class AdminStates(StatesGroup):
     waiting_for_channel = State()
     waiting_for_broadcast = State()
+    waiting_for_broadcast_date = State()
+    waiting_for_broadcast_code = State()
     waiting_for_movie_code = State()
     waiting_for_movie_file = State()
     waiting_for_movie_title = State()
     waiting_for_delete_code = State()
     waiting_for_admin_id = State()
+    waiting_for_import_file = State()
+    waiting_for_series_code = State()
+    waiting_for_episode_files = State()
+    waiting_for_link_code = State()
+
+
+# Episode uploads collected per admin until "Tayyor": (message_id, file_id).
+# Kept here rather than in FSM data so concurrent album messages can't race.
+# Process-local: after a restart the FSM state survives but the files sent so
+# far don't, and "Tayyor" asks for them again.
+pending_episodes = {}
+# Series deliveries (paced albums): one background task per chat drains that
+# chat's queue of (message, movie, episodes), so series never interleave or
+# stack up against the same chat's flood limit. Cancelled on shutdown.
+episode_queues = {}
+episode_tasks = {}
 
 
 # Helper function to check if user is admin
 async def is_admin(user_id: int) -> bool:
     """Check if user is admin (from config or database)"""
-    if user_id in ADMIN_IDS:
-        return True
-    return await is_admin_in_db(user_id)
+    return is_admin_user(user_id)
+
+
+def movie_caption(movie: dict):
+    return f"🎬 {movie['title'] or 'Kino'}\n\n{movie['description'] or ''}"
+
+
+async def send_movie(message: Message, movie: dict):
+    """Send a movie to the chat of `message` and count the delivery"""
+    try:
+        if movie.get('media_type') == "document":
+            await message.answer_document(
+                document=movie['file_id'],
+                caption=movie_caption(movie),
+                reply_markup=get_movie_keyboard()
+            )
+        else:
+            await message.answer_video(
+                video=movie['file_id'],
+                caption=movie_caption(movie),
+                reply_markup=get_movie_keyboard()
+            )
+        record_movie_sent(movie['code'], message.chat.id)
+    except Exception as e:
+        logger.error(f"Error sending movie: {e}")
+        await message.answer("❌ Kino yuborishda xatolik yuz berdi.")
+        return
+    
+    await deliver_episodes(message, movie)
+
+
+async def deliver_episodes(message: Message, movie: dict):
+    """Queue a series' episodes for the chat's background sender, off the update worker"""
+    episodes = await get_episodes(movie['code'])
+    if not episodes:
+        return
+    chat_id = message.chat.id
+    episode_queues.setdefault(chat_id, []).append((message, movie, episodes))
+    if chat_id not in episode_tasks:
+        episode_tasks[chat_id] = asyncio.create_task(send_episode_queue(chat_id))
+
+
+async def send_episode_queue(chat_id: int):
+    """Send a chat's queued series one after another"""
+    queue = episode_queues[chat_id]
+    try:
+        first = True
+        while queue:
+            message, movie, episodes = queue.pop(0)
+            if not first:
+                await asyncio.sleep(SERIES_GROUP_DELAY)
+            first = False
+            if not await send_episodes(message, movie, episodes):
+                break  # the chat is flood-limited or failing, drop the rest
+    finally:
+        episode_queues.pop(chat_id, None)
+        episode_tasks.pop(chat_id, None)
+
+
+async def send_episodes(message: Message, movie: dict, episodes: list):
+    """Send a series' episodes as albums of 10, paced for flood control; False on failure"""
+    for i in range(0, len(episodes), 10):
+        if i:
+            await asyncio.sleep(SERIES_GROUP_DELAY)
+        media = [
+            InputMediaVideo(media=file_id, caption=f"🎬 {movie['title'] or 'Kino'} — {number}-qism")
+            for number, file_id in episodes[i:i + 10]
+        ]
+        for attempt in range(3):
+            try:
+                await message.answer_media_group(media)
+                break
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Error sending episodes of {movie['code']}: {e}")
+                await message.answer("❌ Qismlarni yuborishda xatolik yuz berdi.")
+                return False
+        else:
+            # Still flood-limited after every retry: stop rather than skip an album
+            logger.error(f"Episodes of {movie['code']}: flood control persisted, stopped at album {i // 10 + 1}")
+            await message.answer("❌ Qismlarni yuborishda xatolik yuz berdi.")
+            return False
+    return True
+
+
+async def send_movies(message: Message, movies: list):
+    """Send up to 10 movies as one media group (one API call)"""
+    if len(movies) == 1:
+        await send_movie(message, movies[0])
+        return
+    
+    try:
+        await message.answer_media_group([
+            InputMediaVideo(media=movie['file_id'], caption=movie_caption(movie)) for movie in movies
+        ])
+    except Exception as e:
+        # e.g. a movie stored as a document can't join a video album
+        logger.warning(f"Media group failed, sending one by one: {e}")
+        for movie in movies:
+            await send_movie(message, movie)
+        return
+    
+    for movie in movies:
+        record_movie_sent(movie['code'], message.chat.id)
+        await deliver_episodes(message, movie)
 
 
-# Start command handler
+def start_payload_codes(payload: str):
+    """Codes a /start payload may carry: base64url-encoded, or plain in older links"""
+    codes = []
+    try:
+        codes.append(decode_payload(payload))
+    except ValueError:
+        pass  # not base64url (also covers undecodable bytes)
+    codes.append(payload)
+    return codes
+
+
+# Start command handler (t.me/<bot>?start=<payload> deep links deliver the movie directly)
 @dp.message(Command("start"))
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, command: CommandObject):
     user = message.from_user
     await add_user(user.id, user.username, user.first_name, user.last_name)
     
+    # "subscribe" comes from the inline mode button, not a movie link
+    payload = command.args.strip() if command.args and command.args != "subscribe" else None
+    movie = None
+    if payload:
+        for candidate in start_payload_codes(payload):
+            movie = await get_movie_by_code(candidate)
+            if movie:
+                break
+    code = movie['code'] if movie else None
+    
     # Check subscription
     is_subscribed, not_subscribed_channels = await check_user_subscription(bot, user.id)
     
     if not is_subscribed:
         text = MESSAGES["not_subscribed"]
-        keyboard = get_subscription_keyboard(not_subscribed_channels)
+        keyboard = get_subscription_keyboard(not_subscribed_channels, movie_code=code)
         await message.answer(text, reply_markup=keyboard)
         return
     
+    if movie:
+        await send_movie(message, movie)
+        return
+    if payload:
+        await message.answer(MESSAGES["movie_not_found"])
+    
     # Show keyboard with admin button if user is admin
     main_keyboard = get_main_keyboard(is_admin=await is_admin(user.id))
     await message.answer(MESSAGES["start"], reply_markup=main_keyboard)
 
 
-# Check subscription callback
-@dp.callback_query(F.data == "check_subscription")
+# Check subscription callback ("check_subscription_<CODE>" when started from a deep link)
+@dp.callback_query(F.data.startswith("check_subscription"))
 async def callback_check_subscription(callback: CallbackQuery):
     user_id = callback.from_user.id
-    is_subscribed, not_subscribed_channels = await check_user_subscription(bot, user_id)
+    code = callback.data[len("check_subscription_"):] or None
+    is_subscribed, not_subscribed_channels = await check_user_subscription(bot, user_id, force=True)
     
     if not is_subscribed:
         text = MESSAGES["not_subscribed"]
-        keyboard = get_subscription_keyboard(not_subscribed_channels)
+        keyboard = get_subscription_keyboard(not_subscribed_channels, movie_code=code)
         await callback.message.edit_text(text, reply_markup=keyboard)
     else:
         await callback.message.edit_text(MESSAGES["subscribed"])
-        main_keyboard = get_main_keyboard(is_admin=await is_admin(user_id))
-        await callback.message.answer(MESSAGES["start"], reply_markup=main_keyboard)
+        movie = await get_movie_by_code(code) if code else None
+        if movie:
+            await send_movie(callback.message, movie)
+        else:
+            main_keyboard = get_main_keyboard(is_admin=await is_admin(user_id))
+            await callback.message.answer(MESSAGES["start"], reply_markup=main_keyboard)
     
     await callback.answer()
 
 
+# Membership changes in mandatory channels (bot must be channel admin)
+@dp.chat_member()
+async def on_chat_member_update(event: ChatMemberUpdated):
+    member = event.new_chat_member
+    handle_member_update(event.chat.id, event.chat.username, member.user.id, member.status)
+
+
 # Movie request handler - LAST HANDLER (catches all other text)
 @dp.message(F.text, StateFilter(None))
 async def handle_movie_request(message: Message, state: FSMContext):
@@ -120,24 +300,100 @@ async def handle_movie_request(message: Message, state: FSMContext):
         await message.answer(text, reply_markup=keyboard)
         return
     
-    # Search for movie
+    # Search for movie: the whole text first, codes may contain spaces, commas or semicolons
     code = message.text.strip()
     movie = await get_movie_by_code(code)
-    
     if movie:
-        try:
-            await message.answer_video(
-                video=movie['file_id'],
-                caption=f"🎬 {movie['title'] or 'Kino'}\n\n{movie['description'] or ''}",
-                reply_markup=get_movie_keyboard()
-            )
-        except Exception as e:
-            logger.error(f"Error sending movie: {e}")
-            await message.answer("❌ Kino yuborishda xatolik yuz berdi.")
+        await send_movie(message, movie)
+        return
+    
+    # Several codes in one message: one query, one media group
+    codes = list(dict.fromkeys(c.upper() for c in re.split(r"[\s,;]+", code) if c))
+    codes, extra = codes[:MULTI_CODE_LIMIT], codes[MULTI_CODE_LIMIT:]
+    if extra:
+        await message.answer(MESSAGES["too_many_codes"].format(limit=MULTI_CODE_LIMIT, codes=", ".join(extra)))
+    if codes and codes != [code.upper()]:
+        movies = await get_movies_by_codes(codes)
+        found = [movies[c] for c in codes if movies[c]]
+        if found:
+            await send_movies(message, found)
+            missing = [c for c in codes if not movies[c]]
+            if missing:
+                await message.answer(MESSAGES["movies_partly_found"].format(codes=", ".join(missing)))
+            return
+    
+    # Not a code: maybe a title, suggest the best matches
+    results = await search_movies(code)
+    if results:
+        await message.answer(MESSAGES["movie_suggestions"], reply_markup=get_search_results_keyboard(results))
     else:
         await message.answer(MESSAGES["movie_not_found"])
 
 
+# Movie picked from search suggestions
+@dp.callback_query(F.data.startswith("movie_"))
+async def callback_movie(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    is_subscribed, not_subscribed_channels = await check_user_subscription(bot, user_id)
+    
+    if not is_subscribed:
+        text = MESSAGES["not_subscribed"]
+        keyboard = get_subscription_keyboard(not_subscribed_channels)
+        await callback.message.answer(text, reply_markup=keyboard)
+        await callback.answer()
+        return
+    
+    movie = await get_movie_by_code(callback.data[len("movie_"):])
+    if movie:
+        await send_movie(callback.message, movie)
+        await callback.answer()
+    else:
+        await callback.answer(MESSAGES["movie_not_found"], show_alert=True)
+
+
+def inline_result(movie: dict):
+    """Inline result of the movie's stored media type"""
+    common = dict(
+        id=movie['code'][:64],
+        title=movie['title'] or movie['code'],
+        description=f"Kod: {movie['code']}",
+        caption=movie_caption(movie)
+    )
+    if movie.get('media_type') == "document":
+        return InlineQueryResultCachedDocument(document_file_id=movie['file_id'], **common)
+    return InlineQueryResultCachedVideo(video_file_id=movie['file_id'], **common)
+
+
+# Inline search: @bot <query>
+@dp.inline_query()
+async def inline_search(query: InlineQuery):
+    is_subscribed, _ = await check_user_subscription(bot, query.from_user.id)
+    
+    if not is_subscribed:
+        await query.answer(
+            [],
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=True,
+            button=InlineQueryResultsButton(text="📢 Kanallarga a'zo bo'ling", start_parameter="subscribe")
+        )
+        return
+    
+    movies = await get_inline_results(query.query)
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    page = movies[offset:offset + 50]  # Telegram's per-answer maximum
+    
+    results = [inline_result(movie) for movie in page]
+    next_offset = str(offset + 50) if offset + 50 < len(movies) else ""
+    
+    # Personal, because the answer depends on the user's subscriptions
+    try:
+        await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, next_offset=next_offset)
+    except TelegramBadRequest as e:
+        # One bad file_id fails the whole answer; don't keep serving the same list
+        logger.error(f"Inline answer for {query.query!r} rejected: {e}")
+        forget_inline_results(query.query)
+
+
 # Admin panel command
 @dp.message(Command("admin"))
 async def cmd_admin(message: Message):
@@ -169,18 +425,58 @@ async def callback_admin_stats(callback: CallbackQuery):
         await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
         return
     
-    total_users = await get_user_count()
-    active_users = await get_active_user_count()
-    total_movies = await get_movie_count()
-    total_channels = await get_channel_count()
+    text = MESSAGES["statistics"].format(**await get_stats())
+    
+    keyboard = get_back_keyboard()
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass  # Same snapshot as the message already shows
+    await callback.answer()
+
+
+# Daily statistics (precomputed rows from the statistics table)
+@dp.callback_query(F.data.startswith("daily_stats_"))
+async def callback_daily_stats(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    days = int(callback.data.split("_")[-1])
+    rows = await get_daily_statistics(days)
     
-    text = MESSAGES["statistics"].format(
-        total_users=total_users,
-        active_users=active_users,
-        total_movies=total_movies,
-        total_channels=total_channels
+    lines = [f"{day}: 👥 +{new_users} | 🎬 {movies_sent}" for day, new_users, movies_sent in rows]
+    text = MESSAGES["daily_statistics"].format(
+        days=days,
+        rows="\n".join(lines) or "Ma'lumot yo'q.",
+        new_users=sum(row[1] for row in rows),
+        movies_sent=sum(row[2] for row in rows)
     )
     
+    keyboard = get_daily_stats_keyboard()
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass  # Same period pressed again
+    await callback.answer()
+
+
+# Top movies by deliveries
+@dp.callback_query(F.data == "admin_top_movies")
+async def callback_top_movies(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    movies = await get_top_movies()
+    
+    if not movies:
+        text = "🔥 Hali hech qaysi kino ko'rilmagan."
+    else:
+        text = "🔥 Eng ko'p ko'rilgan kinolar:\n\n"
+        for i, (code, title, views) in enumerate(movies, 1):
+            text += f"{i}. {title or 'Kino'} ({code}) — {views} marta\n"
+    
     keyboard = get_back_keyboard()
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
@@ -306,9 +602,7 @@ async def callback_confirm_delete_channel(callback: CallbackQuery):
         await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
         return
     
-    channel_id = callback.data.split("_")[-1]
-    channels = await get_all_channels()
-    channel = next((c for c in channels if c['id'] == int(channel_id)), None)
+    channel = await get_channel(int(callback.data.split("_")[-1]))
     
     if channel:
         await delete_channel(channel['channel_id'])
@@ -365,14 +659,14 @@ async def process_movie_file(message: Message, state: FSMContext):
         return
     
     if message.video:
-        file_id = message.video.file_id
+        file_id, media_type = message.video.file_id, "video"
     elif message.document:
-        file_id = message.document.file_id
+        file_id, media_type = message.document.file_id, "document"
     else:
         await message.answer("❌ Iltimos, video fayl yuboring!")
         return
     
-    await state.update_data(movie_file_id=file_id)
+    await state.update_data(movie_file_id=file_id, movie_media_type=media_type)
     
     keyboard = get_cancel_keyboard()
     await message.answer(
@@ -394,7 +688,9 @@ async def process_movie_title(message: Message, state: FSMContext):
     code = data['movie_code']
     file_id = data['movie_file_id']
     
-    success = await add_movie(code, file_id, title, added_by=message.from_user.id)
+    success = await add_movie(
+        code, file_id, title, added_by=message.from_user.id, media_type=data.get('movie_media_type', 'video')
+    )
     
     if success:
         await message.answer(f"✅ Kino muvaffaqiyatli qo'shildi!\nKod: {code}")
@@ -406,6 +702,173 @@ async def process_movie_title(message: Message, state: FSMContext):
     await message.answer(MESSAGES["admin_panel"], reply_markup=keyboard)
 
 
+# Bulk movie import - start
+@dp.callback_query(F.data == "admin_import_movies")
+async def callback_import_movies(callback: CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    keyboard = get_cancel_keyboard()
+    await callback.message.edit_text(MESSAGES["import_start"], reply_markup=keyboard)
+    await state.set_state(AdminStates.waiting_for_import_file)
+    await callback.answer()
+
+
+# Bulk movie import - receive CSV/JSONL document
+@dp.message(StateFilter(AdminStates.waiting_for_import_file), F.document)
+async def process_import_file(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        await state.clear()
+        return
+    
+    await message.answer("⏳ Import qilinmoqda...")
+    
+    # Spooled to disk and parsed line by line, so big catalogs don't sit in memory
+    with tempfile.TemporaryFile() as file:
+        await bot.download(message.document, destination=file)
+        result = await import_movies(file, message.document.file_name or "", message.from_user.id)
+    
+    text = MESSAGES["import_done"].format(
+        inserted=result['inserted'],
+        duplicates=len(result['duplicates']),
+        invalid=len(result['invalid'])
+    )
+    if result['duplicates']:
+        shown = ", ".join(result['duplicates'][:20])
+        more = len(result['duplicates']) - 20
+        text += f"\n\n♻️ {shown}" + (f" va yana {more} ta" if more > 0 else "")
+    if result['invalid']:
+        shown = ", ".join(str(line) for line in result['invalid'][:20])
+        text += f"\n\n⚠️ Qatorlar: {shown}"
+    await message.answer(text)
+    
+    await state.clear()
+    keyboard = get_admin_keyboard()
+    await message.answer(MESSAGES["admin_panel"], reply_markup=keyboard)
+
+
+# Add episodes - start
+@dp.callback_query(F.data == "admin_add_episodes")
+async def callback_add_episodes(callback: CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    keyboard = get_cancel_keyboard()
+    await callback.message.edit_text(MESSAGES["episodes_start"], reply_markup=keyboard)
+    await state.set_state(AdminStates.waiting_for_series_code)
+    await callback.answer()
+
+
+# Add episodes - receive series code
+@dp.message(StateFilter(AdminStates.waiting_for_series_code), F.text)
+async def process_series_code(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
+    
+    code = message.text.strip().upper()
+    if not await get_movie_by_code(code):
+        await message.answer(MESSAGES["movie_not_found"], reply_markup=get_cancel_keyboard())
+        return
+    
+    pending_episodes[message.from_user.id] = []
+    await state.update_data(series_code=code)
+    await state.set_state(AdminStates.waiting_for_episode_files)
+    
+    count = len(await get_episodes(code))
+    await message.answer(
+        MESSAGES["episodes_upload"].format(code=code, count=count),
+        reply_markup=get_episodes_done_keyboard()
+    )
+
+
+# Add episodes - collect files (no DB writes until "Tayyor")
+@dp.message(StateFilter(AdminStates.waiting_for_episode_files), F.video)
+async def process_episode_file(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
+    
+    file_id = message.video.file_id
+    pending_episodes.setdefault(message.from_user.id, []).append((message.message_id, file_id))
+    
+    # One confirmation per album, not per video
+    if not message.media_group_id or len(pending_episodes[message.from_user.id]) % 10 == 1:
+        await message.answer(
+            f"📥 Qabul qilindi: {len(pending_episodes[message.from_user.id])} ta",
+            reply_markup=get_episodes_done_keyboard()
+        )
+
+
+# Add episodes - episodes are sent as video albums, so files must be videos
+@dp.message(StateFilter(AdminStates.waiting_for_episode_files), F.document)
+async def process_episode_document(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
+    
+    await message.answer("❌ Qismlarni video qilib yuboring (fayl emas).", reply_markup=get_episodes_done_keyboard())
+
+
+# Add episodes - save all collected files in one transaction
+@dp.callback_query(F.data == "episodes_done", StateFilter(AdminStates.waiting_for_episode_files))
+async def callback_episodes_done(callback: CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    files = sorted(pending_episodes.pop(callback.from_user.id, []))
+    if not files:
+        await callback.answer("❌ Hali birorta ham qism yuborilmadi!", show_alert=True)
+        return
+    
+    code = (await state.get_data())['series_code']
+    first, last = await add_episodes(code, [file_id for _, file_id in files])
+    
+    await state.clear()
+    await callback.message.answer(MESSAGES["episodes_added"].format(code=code, first=first, last=last))
+    keyboard = get_admin_keyboard()
+    await callback.message.answer(MESSAGES["admin_panel"], reply_markup=keyboard)
+    await callback.answer()
+
+
+# Deep link for a movie - start
+@dp.callback_query(F.data == "admin_movie_link")
+async def callback_movie_link(callback: CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    keyboard = get_cancel_keyboard()
+    await callback.message.edit_text("🔗 Havola uchun kino kodini kiriting:", reply_markup=keyboard)
+    await state.set_state(AdminStates.waiting_for_link_code)
+    await callback.answer()
+
+
+# Deep link for a movie - receive code
+@dp.message(StateFilter(AdminStates.waiting_for_link_code), F.text)
+async def process_movie_link(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
+    
+    code = message.text.strip().upper()
+    
+    if not await get_movie_by_code(code):
+        await message.answer(MESSAGES["movie_not_found"])
+    else:
+        try:
+            # base64url, so spaces, Cyrillic etc. survive; cmd_start decodes it
+            link = await create_start_link(bot, code, encode=True)
+        except ValueError:
+            # Telegram allows at most 64 characters in a start payload
+            await message.answer("❌ Bu kod havola uchun juda uzun.")
+        else:
+            await message.answer(f"🔗 {code} uchun havola:\n\n{link}")
+    
+    await state.clear()
+    keyboard = get_admin_keyboard()
+    await message.answer(MESSAGES["admin_panel"], reply_markup=keyboard)
+
+
 # Delete movie - start
 @dp.callback_query(F.data == "admin_delete_movie")
 async def callback_delete_movie(callback: CallbackQuery, state: FSMContext):
@@ -442,75 +905,144 @@ async def process_delete_movie(message: Message, state: FSMContext):
     await message.answer(MESSAGES["admin_panel"], reply_markup=keyboard)
 
 
-# Broadcast - start
+# Broadcast - choose audience
 @dp.callback_query(F.data == "admin_broadcast")
 async def callback_broadcast(callback: CallbackQuery, state: FSMContext):
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
         return
     
-    keyboard = get_cancel_keyboard()
-    await callback.message.edit_text(MESSAGES["broadcast_start"], reply_markup=keyboard)
+    await state.clear()
+    keyboard = get_broadcast_segments_keyboard()
+    await callback.message.edit_text(MESSAGES["broadcast_segment"], reply_markup=keyboard)
+    await callback.answer()
+
+
+async def preview_broadcast(message: Message, state: FSMContext, segment: str, value, audience: str):
+    """Show the segment's recipient count and wait for the message to send"""
+    count = await count_segment_users(segment, value)
+    if not count:
+        await state.clear()
+        await message.answer(MESSAGES["broadcast_empty"], reply_markup=get_broadcast_segments_keyboard())
+        return
+    
+    await state.update_data(segment=segment, segment_value=value)
     await state.set_state(AdminStates.waiting_for_broadcast)
+    keyboard = get_cancel_keyboard()
+    await message.answer(MESSAGES["broadcast_start"].format(audience=audience, count=count), reply_markup=keyboard)
+
+
+# Broadcast - audience buttons
+@dp.callback_query(F.data.startswith("broadcast_to_"))
+async def callback_broadcast_segment(callback: CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    segment = callback.data[len("broadcast_to_"):]
+    if segment == "joined":
+        await callback.message.edit_text(MESSAGES["broadcast_joined"], reply_markup=get_cancel_keyboard())
+        await state.set_state(AdminStates.waiting_for_broadcast_date)
+    elif segment == "movie":
+        await callback.message.edit_text(MESSAGES["broadcast_movie"], reply_markup=get_cancel_keyboard())
+        await state.set_state(AdminStates.waiting_for_broadcast_code)
+    elif segment.startswith("active_"):
+        days = int(segment.split("_")[1])
+        # Fixed cutoff, so a resumed broadcast keeps the same audience
+        cutoff = int(time.time()) - days * 86400
+        await preview_broadcast(callback.message, state, "active", cutoff, f"oxirgi {days} kunda faol")
+    else:
+        await preview_broadcast(callback.message, state, "all", None, "barcha foydalanuvchilar")
     await callback.answer()
 
 
-# Broadcast - send message
-@dp.message(StateFilter(AdminStates.waiting_for_broadcast))
-async def process_broadcast(message: Message, state: FSMContext):
+# Broadcast - receive join date
+@dp.message(StateFilter(AdminStates.waiting_for_broadcast_date), F.text)
+async def process_broadcast_date(message: Message, state: FSMContext):
     if not await is_admin(message.from_user.id):
         return
     
-    users = await get_all_users()
-    success = 0
-    failed = 0
+    try:
+        date = datetime.strptime(message.text.strip(), "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        await message.answer("❌ Sana noto'g'ri! Misol: 2024-05-01", reply_markup=get_cancel_keyboard())
+        return
     
-    await message.answer("📢 Xabar yuborilmoqda...")
+    await preview_broadcast(message, state, "joined", date, f"{date} dan keyin qo'shilganlar")
+
+
+# Broadcast - receive movie code
+@dp.message(StateFilter(AdminStates.waiting_for_broadcast_code), F.text)
+async def process_broadcast_code(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
     
-    for user in users:
-        try:
-            await bot.copy_message(
-                chat_id=user['user_id'],
-                from_chat_id=message.chat.id,
-                message_id=message.message_id
-            )
-            success += 1
-            await asyncio.sleep(0.05)  # Avoid hitting rate limits
-        except Exception as e:
-            failed += 1
-            logger.error(f"Failed to send to {user['user_id']}: {e}")
+    code = message.text.strip().upper()
+    await preview_broadcast(message, state, "movie", code, f"{code} kodini so'raganlar")
+
+
+# Broadcast - send message
+@dp.message(StateFilter(AdminStates.waiting_for_broadcast))
+async def process_broadcast(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
     
-    text = MESSAGES["broadcast_success"].format(success=success, failed=failed)
-    await message.answer(text)
+    data = await state.get_data()
+    # Runs in the background; progress is persisted and survives restarts
+    await start_broadcast(
+        bot, message.from_user.id, message.chat.id, message.message_id,
+        data.get("segment", "all"), data.get("segment_value")
+    )
     
     await state.clear()
     keyboard = get_admin_keyboard()
     await message.answer(MESSAGES["admin_panel"], reply_markup=keyboard)
 
 
-# Users list
+# Broadcast - stop
+@dp.callback_query(F.data.startswith("broadcast_cancel_"))
+async def callback_cancel_broadcast(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
+        return
+    
+    job_id = int(callback.data.split("_")[-1])
+    if await cancel_broadcast(bot, job_id):
+        await callback.answer("⏹ To'xtatildi!")
+    else:
+        await callback.answer("❌ Bu xabar yuborish allaqachon tugagan!", show_alert=True)
+
+
+# Users list (keyset pages of 10)
 @dp.callback_query(F.data == "admin_users")
+@dp.callback_query(F.data.startswith("users_next_"))
+@dp.callback_query(F.data.startswith("users_prev_"))
 async def callback_users(callback: CallbackQuery):
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Sizda admin huquqi yo'q!", show_alert=True)
         return
     
-    users = await get_all_users()
-    total = len(users)
+    if callback.data.startswith("users_next_"):
+        page = await get_users_page(after_id=int(callback.data.split("_")[-1]))
+    elif callback.data.startswith("users_prev_"):
+        page = await get_users_page(before_id=int(callback.data.split("_")[-1]))
+    else:
+        page = await get_users_page()
+    users, has_previous, has_next = page
+    total = await get_user_count()
     
     text = f"👥 Foydalanuvchilar ro'yxati\n\n"
     text += f"Jami: {total} ta foydalanuvchi\n\n"
     
-    # Show first 10 users
-    for i, user in enumerate(users[:10], 1):
-        username = f"@{user['username']}" if user['username'] else "Username yo'q"
-        name = user['first_name'] or "No name"
-        text += f"{i}. {name} ({username})\n"
+    for user_id, username, first_name in users:
+        username = f"@{username}" if username else "Username yo'q"
+        name = first_name or "No name"
+        text += f"• {name} ({username}) — {user_id}\n"
     
-    if total > 10:
-        text += f"\n... va yana {total - 10} ta foydalanuvchi"
-    
-    keyboard = get_back_keyboard()
+    if users:
+        keyboard = get_users_page_keyboard(users[0][0], users[-1][0], has_previous, has_next)
+    else:
+        keyboard = get_back_keyboard()
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
@@ -639,6 +1171,7 @@ async def callback_confirm_delete_admin(callback: CallbackQuery):
 @dp.callback_query(F.data == "cancel")
 async def callback_cancel(callback: CallbackQuery, state: FSMContext):
     await state.clear()
+    pending_episodes.pop(callback.from_user.id, None)
     
     if await is_admin(callback.from_user.id):
         keyboard = get_admin_keyboard()
@@ -658,41 +1191,58 @@ async def callback_close(callback: CallbackQuery):
 
 # Main function
 async def on_startup(bot: Bot):
-    # Initialize database
+    # Open the shared connection pool and initialize database
+    await open_db()
     await init_db()
     await init_default_channel()
-    logger.info("Database initialized")
+    warmed = await warm_movie_cache()
+    logger.info(f"Database initialized, {warmed} popular movies cached")
+    storage.start()
+    
+    await resume_broadcasts(bot)
     
     # Set webhook
     webhook_url = os.getenv('RAILWAY_PUBLIC_DOMAIN') or os.getenv('RAILWAY_STATIC_URL')
     if webhook_url:
         # Remove https:// if present
         webhook_url = webhook_url.replace('https://', '').replace('http://', '')
-        await bot.set_webhook(f"https://{webhook_url}/webhook")
+        await bot.set_webhook(
+            f"https://{webhook_url}/webhook",
+            allowed_updates=dp.resolve_used_update_types()
+        )
         logger.info(f"Webhook set to https://{webhook_url}/webhook")
     else:
         logger.info("No webhook URL found, using polling")
 
 
 async def on_shutdown(bot: Bot):
-    await bot.delete_webhook()
-    logger.info("Webhook deleted")
+    if os.getenv('RAILWAY_PUBLIC_DOMAIN') or os.getenv('RAILWAY_STATIC_URL'):
+        await bot.delete_webhook()
+        logger.info("Webhook deleted")
+    
+    tasks = list(episode_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await stop_broadcasts()
+    await close_db()
+    logger.info("Database closed")
 
 
 def main():
     # Check if running on Railway (webhook mode) or locally (polling mode)
     webhook_url = os.getenv('RAILWAY_PUBLIC_DOMAIN') or os.getenv('RAILWAY_STATIC_URL')
     
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    
     if webhook_url:
         # Webhook mode for Railway
-        dp.startup.register(on_startup)
-        dp.shutdown.register(on_shutdown)
-        
         # Create aiohttp app
         app = web.Application()
         
-        # Create webhook handler
-        webhook_requests_handler = SimpleRequestHandler(
+        # Create webhook handler (acks at once, a worker pool processes updates by priority)
+        webhook_requests_handler = QueuedRequestHandler(
             dispatcher=dp,
             bot=bot,
         )
@@ -711,11 +1261,8 @@ def main():
     else:
         # Polling mode for local development
         async def start_polling():
-            await init_db()
-            await init_default_channel()
-            logger.info("Database initialized")
             logger.info("Bot started in polling mode")
-            await dp.start_polling(bot)
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
         
         asyncio.run(start_polling())
 
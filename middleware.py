@@ -1,24 +1,115 @@
+import asyncio
+import logging
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from database import get_all_channels
+from cache import TTLCache, MISSING
+from config import (
+    SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL,
+    SUBSCRIPTION_CHECK_CONCURRENCY, SUBSCRIPTION_CHECK_TIMEOUT, SUBSCRIPTION_FAIL_OPEN,
+    MEMBERSHIP_MAX_AGE
+)
+from database import get_all_channels, channel_registry, record_membership, get_memberships
 
+logger = logging.getLogger(__name__)
 
-async def check_user_subscription(bot: Bot, user_id: int):
-    """Check if user is subscribed to all mandatory channels"""
+# (user_id, channel_id) -> is member
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_POSITIVE_TTL)
+_cache_channels_version = None
+
+# Shared by all users so a traffic spike can't flood the Bot API
+_check_limiter = asyncio.Semaphore(SUBSCRIPTION_CHECK_CONCURRENCY)
+
+
+async def _fetch_membership(bot: Bot, user_id: int, channel_id: str):
+    """Ask Telegram whether the user is a member; None if it could not be checked"""
+    try:
+        async with _check_limiter:
+            member = await asyncio.wait_for(
+                bot.get_chat_member(chat_id=channel_id, user_id=user_id),
+                timeout=SUBSCRIPTION_CHECK_TIMEOUT
+            )
+    except asyncio.TimeoutError:
+        logger.warning(f"get_chat_member timed out for {channel_id}")
+        return None
+    except Exception as e:
+        logger.warning(f"get_chat_member failed for {channel_id}: {e}")
+        return None
+    
+    verdict = member.status not in ['left', 'kicked']
+    remember_membership(channel_id, user_id, verdict)
+    return verdict
+
+
+def _cache_verdict(channel_id: str, user_id: int, is_member: bool):
+    ttl = SUBSCRIPTION_POSITIVE_TTL if is_member else SUBSCRIPTION_NEGATIVE_TTL
+    subscription_cache.set((user_id, channel_id), is_member, ttl=ttl)
+
+
+def remember_membership(channel_id: str, user_id: int, is_member: bool):
+    """Store a membership verdict in memory and in the channel_members table"""
+    _cache_verdict(channel_id, user_id, is_member)
+    record_membership(channel_id, user_id, is_member)
+
+
+def handle_member_update(chat_id: int, chat_username: str, user_id: int, status: str):
+    """Apply a chat_member update if the chat is a mandatory channel"""
+    is_member = status not in ['left', 'kicked']
+    for channel_id in channel_registry.resolve(chat_id, chat_username):
+        remember_membership(channel_id, user_id, is_member)
+
+
+async def check_user_subscription(bot: Bot, user_id: int, force: bool = False):
+    """Check if user is subscribed to all mandatory channels
+    
+    Verdicts come from the in-memory cache, then the channel_members table
+    (kept current by chat_member updates), and only then from get_chat_member.
+    force=True re-checks the channels the user was last seen not subscribed to
+    (used by the "Tekshirish" button). Channels that can't be checked are not
+    cached and follow SUBSCRIPTION_FAIL_OPEN.
+    """
+    global _cache_channels_version
     channels = await get_all_channels()
     
     if not channels:
         return True, None
     
-    not_subscribed = []
+    # Drop all verdicts when channels were added or removed
+    if _cache_channels_version != channel_registry.version:
+        subscription_cache.clear()
+        _cache_channels_version = channel_registry.version
+    
+    verdicts = {}
+    to_fetch = []
     
     for channel in channels:
-        try:
-            member = await bot.get_chat_member(chat_id=channel['channel_id'], user_id=user_id)
-            if member.status in ['left', 'kicked']:
-                not_subscribed.append(channel)
-        except Exception:
-            not_subscribed.append(channel)
+        verdict = subscription_cache.get((user_id, channel['channel_id']))
+        if verdict is MISSING or (force and not verdict):
+            to_fetch.append(channel)
+        else:
+            verdicts[channel['channel_id']] = verdict
+    
+    # Then the membership table; only pairs it doesn't know go to the API
+    if to_fetch:
+        known = await get_memberships(user_id, [c['channel_id'] for c in to_fetch], MEMBERSHIP_MAX_AGE)
+        unknown = []
+        for channel in to_fetch:
+            verdict = known.get(channel['channel_id'])
+            if verdict is None or (force and not verdict):
+                unknown.append(channel)
+            else:
+                _cache_verdict(channel['channel_id'], user_id, verdict)
+                verdicts[channel['channel_id']] = verdict
+        to_fetch = unknown
+    
+    # Remaining channels are checked concurrently: one round trip instead of N
+    if to_fetch:
+        results = await asyncio.gather(*(
+            _fetch_membership(bot, user_id, channel['channel_id']) for channel in to_fetch
+        ))
+        for channel, verdict in zip(to_fetch, results):
+            verdicts[channel['channel_id']] = SUBSCRIPTION_FAIL_OPEN if verdict is None else verdict
+    
+    not_subscribed = [channel for channel in channels if not verdicts[channel['channel_id']]]
     
     if not_subscribed:
         return False, not_subscribed
@@ -26,9 +117,15 @@ async def check_user_subscription(bot: Bot, user_id: int):
     return True, None
 
 
-def get_subscription_keyboard(channels):
-    """Generate keyboard with subscription buttons"""
+def get_subscription_keyboard(channels, movie_code: str = None):
+    """Generate keyboard with subscription buttons
+    
+    movie_code (from a deep link) rides along in the check button so the movie
+    is sent as soon as the subscription is confirmed.
+    """
     keyboard = []
+    if movie_code and len(f"check_subscription_{movie_code}".encode()) > 64:
+        movie_code = None  # callback_data limit
     
     for channel in channels:
         channel_name = channel['channel_username'] if channel['channel_username'] else channel['channel_id']
@@ -44,7 +141,7 @@ def get_subscription_keyboard(channels):
     
     keyboard.append([InlineKeyboardButton(
         text="✅ Tekshirish",
-        callback_data="check_subscription"
+        callback_data=f"check_subscription_{movie_code}" if movie_code else "check_subscription"
     )])
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
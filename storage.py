@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from cache import TTLCache, MISSING
+from config import FSM_STATE_TTL, FSM_SWEEP_INTERVAL, FSM_CACHE_SIZE, FSM_CACHE_TTL
+from database import get_fsm_record, save_fsm_state, save_fsm_data, delete_stale_fsm
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """aiogram FSM storage in the bot's SQLite database, shared by all bot processes
+
+    Writes go straight to SQLite and into an in-process cache that also
+    remembers "no conversation", so ordinary user updates don't read SQLite.
+    Conversations idle for longer than state_ttl are ignored and evicted.
+    """
+
+    def __init__(self, state_ttl: int = FSM_STATE_TTL, sweep_interval: int = FSM_SWEEP_INTERVAL,
+                 cache_ttl: float = FSM_CACHE_TTL):
+        self.state_ttl = state_ttl
+        self.sweep_interval = sweep_interval
+        self._cache = TTLCache(FSM_CACHE_SIZE, cache_ttl)  # key -> (state, data, updated_at)
+        self._task = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _load(self, key: str):
+        """(state, data) of a live conversation, (None, {}) if there is none"""
+        record = self._cache.get(key)
+        if record is MISSING:
+            generation = self._cache.generation
+            row = await get_fsm_record(key, self.state_ttl)
+            state, data, updated_at = row if row else (None, None, 0)
+            record = (state, json.loads(data) if data else {}, updated_at)
+            self._cache.set(key, record, generation=generation)
+        state, data, updated_at = record
+        if state is None and not data:
+            return None, {}
+        if updated_at < time.time() - self.state_ttl:
+            # Expired while cached: same as a row older than state_ttl in SQLite
+            return None, {}
+        return state, data
+
+    def _remember(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        # Invalidate first so a load that raced this write can't cache the old record
+        self._cache.invalidate(key)
+        self._cache.set(key, (state, data, int(time.time())))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = self._key(key)
+        state = state.state if isinstance(state, State) else state
+        _, data = await self._load(key)
+        await save_fsm_state(key, state, self.state_ttl)
+        self._remember(key, state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = self._key(key)
+        state, _ = await self._load(key)
+        data = dict(data)
+        payload = json.dumps(data, separators=(",", ":"), ensure_ascii=False) if data else None
+        await save_fsm_data(key, payload, self.state_ttl)
+        self._remember(key, state, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return data.copy()
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                evicted = await delete_stale_fsm(self.state_ttl)
+                if evicted:
+                    logger.info(f"Evicted {evicted} stale FSM conversations")
+            except Exception as e:
+                logger.error(f"Failed to evict stale FSM conversations: {e}")
+
+    def start(self):
+        """Start the eviction loop (call once the database is open)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._cache.clear()
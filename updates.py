@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from config import (
+    UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_DEDUP_SIZE, UPDATE_DRAIN_TIMEOUT,
+    UPDATE_PRIORITY_BURST, UPDATE_SHED_AFTER_MS
+)
+from database import is_admin_user
+
+logger = logging.getLogger(__name__)
+
+# Update priorities, most urgent first
+PRIORITY_ADMIN, PRIORITY_CALLBACK, PRIORITY_MESSAGE, PRIORITY_START = range(4)
+# From this priority down, stale updates are shed rather than answered late
+SHEDDABLE = PRIORITY_MESSAGE
+
+
+def classify(update: dict) -> int:
+    """Priority of a raw update: admin actions, callbacks, movie requests, /start"""
+    event = update.get("message") or update.get("callback_query") or update.get("inline_query") or {}
+    sender = (event.get("from") or {}).get("id")
+    if sender is not None and is_admin_user(sender):
+        return PRIORITY_ADMIN
+    # Subscription checks and membership changes are cheap and a user is waiting on them
+    if "callback_query" in update or "chat_member" in update or "my_chat_member" in update:
+        return PRIORITY_CALLBACK
+    text = (update.get("message") or {}).get("text") or ""
+    if text.startswith("/start"):
+        return PRIORITY_START
+    return PRIORITY_MESSAGE
+
+
+class PriorityUpdateQueue:
+    """Bounded queue with one FIFO per priority level
+
+    get() serves the most urgent level, but after `burst` picks in a row that
+    passed over waiting lower levels it serves the oldest item of those levels,
+    so nothing starves. When full, a new update may push out the oldest update
+    of a less urgent level.
+    """
+
+    def __init__(self, maxsize: int, levels: int = 4, burst: int = UPDATE_PRIORITY_BURST):
+        self.maxsize = maxsize
+        self.burst = burst
+        self.shed = 0
+        self._levels = [deque() for _ in range(levels)]
+        self._size = 0
+        self._bypassed = 0
+        self._unfinished = 0
+        self._not_empty = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self):
+        return self._size
+
+    def full(self):
+        return self._size >= self.maxsize
+
+    def put_nowait(self, priority: int, item) -> bool:
+        """Queue an item (stamped with the current time); False if there is no room"""
+        if self.full() and not self._shed_below(priority):
+            return False
+        self._levels[priority].append((time.monotonic(), item))
+        self._size += 1
+        self._unfinished += 1
+        self._finished.clear()
+        self._not_empty.set()
+        return True
+
+    def _shed_below(self, priority: int) -> bool:
+        for level in range(len(self._levels) - 1, priority, -1):
+            if self._levels[level]:
+                self._levels[level].popleft()
+                self._size -= 1
+                self.shed += 1
+                self.task_done()
+                return True
+        return False
+
+    async def get(self):
+        """(priority, enqueued_at, item) of the next item to process"""
+        while not self._size:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        waiting = [level for level, queue in enumerate(self._levels) if queue]
+        level = waiting[0]
+        if len(waiting) > 1:
+            self._bypassed += 1
+            if self._bypassed > self.burst:
+                # Starvation protection: the longest-waiting passed-over item goes next
+                level = min(waiting[1:], key=lambda lvl: self._levels[lvl][0][0])
+                self._bypassed = 0
+        else:
+            self._bypassed = 0
+        enqueued_at, item = self._levels[level].popleft()
+        self._size -= 1
+        return level, enqueued_at, item
+
+    def task_done(self):
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Webhook handler that acknowledges at once and feeds updates from a bounded queue
+
+    A fixed pool of workers runs the dispatcher, so a slow handler never delays
+    Telegram's HTTP response. Updates are served by priority (see classify),
+    stale movie requests and /start are shed under load, a full queue answers
+    503 (Telegram retries later), redelivered update_ids are dropped, and
+    shutdown drains what was accepted.
+    """
+
+    def __init__(self, *args, workers: int = UPDATE_WORKERS, queue_size: int = UPDATE_QUEUE_SIZE,
+                 dedup_size: int = UPDATE_DEDUP_SIZE, drain_timeout: float = UPDATE_DRAIN_TIMEOUT,
+                 shed_after_ms: int = UPDATE_SHED_AFTER_MS, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        self.worker_count = workers
+        self.dedup_size = dedup_size
+        self.drain_timeout = drain_timeout
+        self.shed_after = shed_after_ms / 1000
+        self._queue = PriorityUpdateQueue(maxsize=queue_size)
+        self._seen = OrderedDict()  # recent update_ids, oldest first
+        self._workers = []
+        self._closing = False
+
+    def register(self, app: web.Application, /, path: str, **kwargs):
+        app.on_startup.append(self._start_workers)
+        super().register(app, path=path, **kwargs)
+
+    async def _start_workers(self, app: web.Application):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    def _remember(self, update_id):
+        if update_id is None:
+            return
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+
+    def _busy(self):
+        return web.Response(status=503, headers={"Retry-After": "1"})
+
+    async def _handle_request_background(self, bot, request: web.Request) -> web.Response:
+        if self._closing:
+            return self._busy()
+        update = await request.json(loads=bot.session.json_loads)
+        update_id = update.get("update_id")
+        if update_id in self._seen:
+            # Redelivery of an update we already accepted
+            return web.json_response({}, dumps=bot.session.json_dumps)
+        shed = self._queue.shed
+        if not self._queue.put_nowait(classify(update), (bot, update)):
+            return self._busy()
+        if self._queue.shed != shed:
+            self._log_shed(update)
+        self._remember(update_id)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    def _log_shed(self, update: dict):
+        if self._queue.shed % 100 == 1:
+            logger.warning(
+                f"Overloaded: {self._queue.shed} low-priority updates shed so far "
+                f"({self._queue.qsize()} queued), latest {update.get('update_id')}"
+            )
+
+    async def _worker(self):
+        while True:
+            priority, enqueued_at, (bot, update) = await self._queue.get()
+            try:
+                if priority >= SHEDDABLE and time.monotonic() - enqueued_at > self.shed_after:
+                    self._queue.shed += 1
+                    self._log_shed(update)
+                    continue
+                await self._background_feed_update(bot, update)
+            except Exception as e:
+                logger.error(f"Failed to process update {update.get('update_id')}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def close(self):
+        """Stop accepting updates, finish the queued ones, then close the bot session"""
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutdown: {self._queue.qsize()} queued updates were not processed")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await super().close()